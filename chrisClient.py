@@ -2,15 +2,15 @@
 
 import sys
 import json
-import requests
+import asyncio
 from loguru import logger
 from urllib.parse import urlencode
-from requests.auth import HTTPBasicAuth
-from requests.exceptions import RequestException, Timeout, HTTPError
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 
 from base_client import BaseClient
-from pipeline import Pipeline
+from http_session import get_session, async_request, async_retry_policy
+from pipeline import AsyncPipeline, NOTIFICATION_PLUGIN
+from collection_json import first_value
+from metadata_cache import MetadataCache, plugin_key
 
 # ----------------------------------------
 # Logger Configuration
@@ -28,26 +28,67 @@ logger.remove()
 logger.add(sys.stderr, format=logger_format)
 LOG = logger.debug
 
+ANONYMIZATION_PIPELINE = "DICOM anonymization, niftii conversion, and push to neuro tree v20250326"
+DSDIRCOPY_PLUGIN = {"name": "pl-dsdircopy", "version": "1.0.2"}
+
+
+def build_pipeline_params(send_params: dict) -> dict:
+    """
+    Per-series parameters of the neuro push steps of the anonymization pipeline.
+    """
+    return {
+        'send-dicoms-to-neuro-FS': {
+            "path": f"{send_params['neuro_dcm_location']}/{send_params['folder_name']}/",
+            "include": "*.dcm",
+            "min_size": "0",
+            "timeout": "0",
+            "max_size": "1G",
+            "max_depth": "3"
+        },
+        'send-anon-dicoms-to-neuro-FS': {
+            "path": f"{send_params['neuro_anon_location']}/{send_params['folder_name']}/",
+            "include": "*.dcm",
+            "min_size": "0",
+            "timeout": "0",
+            "max_size": "1G",
+            "max_depth": "3"
+        },
+        'send-niftii-to-neuro-FS': {
+            "path": f"{send_params['neuro_nifti_location']}/{send_params['folder_name']}/",
+            "include": "*",
+            "min_size": "0",
+            "timeout": "0",
+            "max_size": "1G",
+            "max_depth": "3"
+        }
+    }
+
+
+def describe_series(dicom_dir: str, send_params: dict, series_data: str) -> str:
+    """
+    Series details passed on to the pipeline for notifications.
+    ``dicom_dir`` may list several comma separated folders.
+    """
+    d_series = json.loads(series_data)
+    d_series['Folder Name'] = send_params['folder_name']
+    d_series['SeriesDescription'] = ', '.join(path.split('/')[-1] for path in dicom_dir.split(','))
+    return json.dumps(d_series)
+
+
+class ChrisClient(object):
+    """
+    Blocking CUBE client for the health check made before the event loop
+    starts. Submissions go through ``AsyncChrisClient``.
+    """
 
-class ChrisClient(BaseClient):
     def __init__(self, url: str, token: str):
         self.api_base = url.rstrip('/')
-        self.token = token
         self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
 
-    # ----------------------------------------
-    # Retryable request handler
-    # ----------------------------------------
-    @retry(
-        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        stop=stop_after_attempt(5),
-        reraise=True
-    )
-    def make_request(self, method: str, endpoint: str, **kwargs):
-        response = requests.request(
-            method, endpoint, headers=self.headers, timeout=30, **kwargs
-        )
+    def health_check(self):
+        endpoint = f"{self.api_base}/"
+        response = get_session().request("GET", endpoint, headers=self.headers, timeout=30)
+
         response.raise_for_status()
 
         try:
@@ -55,31 +96,35 @@ class ChrisClient(BaseClient):
         except ValueError:
             return response.text
 
-    def post_request(self, endpoint: str, **kwargs):
-        response = requests.request(
-            "POST", endpoint, headers=self.headers, timeout=30, **kwargs
-        )
-        response.raise_for_status()
 
-        try:
-            return response.json()
-        except ValueError:
-            return response.text
+class AsyncChrisClient(BaseClient):
+    """
+    CUBE client on the shared aiohttp session: plugin instances and the
+    anonymization pipeline of each series.
+    """
 
+    def __init__(self, url: str, token: str, cache: MetadataCache = None):
+        self.api_base = url.rstrip('/')
+        self.token = token
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
+        self.cache = cache if cache is not None else MetadataCache()
+        self.pipeline = AsyncPipeline(self.api_base, self.token, self.cache)
 
-    def create_con(self, params: dict):
-        pass
+    # ----------------------------------------
+    # Retryable request handler
+    # ----------------------------------------
+    @async_retry_policy()
+    async def make_request(self, method: str, endpoint: str, **kwargs):
+        return await async_request(method, endpoint, headers=self.headers, **kwargs)
 
-    def health_check(self):
-        endpoint = f"{self.api_base}/"
-        response = requests.request("GET", endpoint, headers=self.headers, timeout=30)
+    async def post_request(self, endpoint: str, **kwargs):
+        return await async_request("POST", endpoint, headers=self.headers, **kwargs)
 
-        response.raise_for_status()
+    async def health_check(self):
+        return await async_request("GET", f"{self.api_base}/", headers=self.headers)
 
-        try:
-            return response.json()
-        except ValueError:
-            return response.text
+    def create_con(self, params: dict):
+        pass
 
     def pacs_pull(self):
         pass  # Placeholder for PACS pull implementation
@@ -87,54 +132,63 @@ class ChrisClient(BaseClient):
     def pacs_push(self):
         pass  # Placeholder for PACS push implementation
 
-    async def anonymize(self, dicom_dir: str, send_params: dict, pv_id: int, series_data: str):
+    async def warm_up(self):
+        """
+        Resolve plugin IDs and pipeline metadata used per series up front.
+        """
+        try:
+            await asyncio.gather(
+                self._get_plugin_id(DSDIRCOPY_PLUGIN),
+                self.pipeline._get_plugin_id(NOTIFICATION_PLUGIN),
+                self.pipeline.get_workflow_template(ANONYMIZATION_PIPELINE)
+            )
+        except Exception as ex:
+            LOG(f"Could not warm up CUBE metadata cache: {ex}")
+
+    async def workflow_jobs(self) -> int:
+        """
+        Number of jobs in one anonymization workflow.
+        """
+        template = await self.pipeline.get_workflow_template(ANONYMIZATION_PIPELINE)
+        return template.total_jobs
+
+    async def anonymize(self, dicom_dir: str, send_params: dict, pv_id: int, series_data: str,
+                        dsdir_inst_id: int = None):
         """
         Run the anonymization pipeline for a given DICOM directory and push results to specified neuro locations.
+        An existing pl-dsdircopy instance can be passed as ``dsdir_inst_id``.
         """
-        d_series = json.loads(series_data)
-        d_series['Folder Name'] = send_params['folder_name']
-        d_series['SeriesDescription'] = dicom_dir.split('/')[-1]
-        dsdir_inst_id = self.run_dicomdir_plugin(dicom_dir, pv_id)
-
-        plugin_params = {
-            'send-dicoms-to-neuro-FS': {
-                "path": f"{send_params['neuro_dcm_location']}/{send_params['folder_name']}/",
-                "include": "*.dcm",
-                "min_size": "0",
-                "timeout": "0",
-                "max_size": "1G",
-                "max_depth": "3"
-            },
-            'send-anon-dicoms-to-neuro-FS': {
-                "path": f"{send_params['neuro_anon_location']}/{send_params['folder_name']}/",
-                "include": "*.dcm",
-                "min_size": "0",
-                "timeout": "0",
-                "max_size": "1G",
-                "max_depth": "3"
-            },
-            'send-niftii-to-neuro-FS': {
-                "path": f"{send_params['neuro_nifti_location']}/{send_params['folder_name']}/",
-                "include": "*",
-                "min_size": "0",
-                "timeout": "0",
-                "max_size": "1G",
-                "max_depth": "3"
-            }
-        }
+        if dsdir_inst_id is None:
+            dsdir_inst_id = await self.start_submission(dicom_dir, pv_id)
 
-        pipe = Pipeline(self.api_base, self.token)
-        d_ret = await pipe.run_pipeline(
+        d_ret = await self.pipeline.run_pipeline(
             previous_inst=dsdir_inst_id,
-            pipeline_name="DICOM anonymization, niftii conversion, and push to neuro tree v20250326",
-            pipeline_params=plugin_params,
+            pipeline_name=ANONYMIZATION_PIPELINE,
+            pipeline_params=build_pipeline_params(send_params),
             recipients=send_params['recipients'],
             smtp_server=send_params['smtp_server'],
-            series_data=json.dumps(d_series)
+            series_data=describe_series(dicom_dir, send_params, series_data)
         )
         return d_ret
 
-    def run_dicomdir_plugin(self, dicom_dir: str, pv_id: int) -> int:
+    async def start_submission(self, dicom_dir: str, pv_id: int) -> int:
+        """
+        Run the pl-dsdircopy plugin on a DICOM directory while the workflow
+        template to chain after it is fetched, so that a cold metadata cache
+        costs one round of lookups instead of two.
+        """
+        dsdir_inst_id, _ = await asyncio.gather(self.run_dicomdir_plugin(dicom_dir, pv_id),
+                                                self._prefetch_workflow_template())
+        return dsdir_inst_id
+
+    async def _prefetch_workflow_template(self):
+        try:
+            await self.pipeline.get_workflow_template(ANONYMIZATION_PIPELINE)
+        except Exception as ex:
+            # run_pipeline fetches it again and reports the failure
+            LOG(f"Could not prefetch the workflow template: {ex}")
+
+    async def run_dicomdir_plugin(self, dicom_dir: str, pv_id: int) -> int:
         """
         Run the pl-dsdircopy plugin on a DICOM directory.
         """
@@ -143,40 +197,31 @@ class ChrisClient(BaseClient):
                 LOG("No directory found in CUBE containing files for search.")
                 raise ValueError("Empty DICOM directory path provided.")
 
-            plugin_id = self._get_plugin_id({"name": "pl-dsdircopy", "version": "1.0.2"})
-            instance_id = self._create_plugin_instance(plugin_id, {
+            plugin_id = await self._get_plugin_id(DSDIRCOPY_PLUGIN)
+            instance_id = await self._create_plugin_instance(plugin_id, {
                 "previous_id": pv_id,
                 "dir": dicom_dir
             })
             return int(instance_id)
         except Exception as ex:
             LOG(f"Error occurred while creating dsdircopy instance {ex}")
+            self.cache.invalidate(plugin_key(self.api_base, DSDIRCOPY_PLUGIN))
 
-    def _create_plugin_instance(self, plugin_id: str, params: dict):
-        """
-        Create a plugin instance and return its ID.
-        """
-        response = self.post_request( f"{self.api_base}/plugins/{plugin_id}/instances/", json=params)
-        items = response.get("collection", {}).get("items", [])
+    async def _create_plugin_instance(self, plugin_id: str, params: dict):
+        response = await self.post_request(f"{self.api_base}/plugins/{plugin_id}/instances/", json=params)
+        instance_id = first_value(response, "id")
+        if instance_id is None:
+            raise RuntimeError("Plugin instance could not be scheduled.")
+        return instance_id
 
-        for item in items:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
+    async def _get_plugin_id(self, params: dict):
+        return await self.cache.get_or_fetch_async(plugin_key(self.api_base, params),
+                                                   lambda: self._search_plugin_id(params))
 
-        raise RuntimeError("Plugin instance could not be scheduled.")
-
-    def _get_plugin_id(self, params: dict):
-        """
-        Fetch plugin ID by search parameters.
-        """
+    async def _search_plugin_id(self, params: dict):
         query_string = urlencode(params)
-        response = self.make_request("GET", f"{self.api_base}/plugins/search/?{query_string}")
-        items = response.get("collection", {}).get("items", [])
-
-        for item in items:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
-
-        raise RuntimeError(f"No plugin found with matching criteria: {params}")
+        response = await self.make_request("GET", f"{self.api_base}/plugins/search/?{query_string}")
+        plugin_id = first_value(response, "id")
+        if plugin_id is None:
+            raise RuntimeError(f"No plugin found with matching criteria: {params}")
+        return plugin_id
@@ -1,13 +1,17 @@
-import requests
 from loguru import logger
-from requests.auth import HTTPBasicAuth
-from requests.exceptions import RequestException, Timeout, HTTPError
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 from urllib.parse import urlencode
 import sys
 
+from http_session import get_session, retry_policy, async_request, async_retry_policy
+from collection_json import items, item_record, first_value
+
 LOG = logger.debug
 
+# Fields of a PACS series item used to track registration
+SERIES_ITEM_FIELDS = frozenset(("SeriesInstanceUID", "folder_path"))
+# Fields of a PACS series item used as a watermark
+MARKER_FIELDS = frozenset(("id", "creation_date", "SeriesInstanceUID"))
+
 logger_format = (
     "<green>{time:YYYY-MM-DD HH:mm:ss}</green> │ "
     "<level>{level: <5}</level> │ "
@@ -21,22 +25,23 @@ logger.add(sys.stderr, format=logger_format)
 
 
 class PACSClient(object):
+    """
+    Client of the CUBE PACS series and files APIs.
+    """
+
     def __init__(self, url: str, token: str):
         self.api_base = url.rstrip('/')
         self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
         self.pacs_series_url = f"{self.api_base}/pacs/series"
+        # SeriesInstanceUID -> folder path, filled from every series search
+        self._folder_cache: dict = {}
 
     # --------------------------
     # Retryable request handler
     # --------------------------
-    @retry(
-        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        stop=stop_after_attempt(5),
-        reraise=True
-    )
+    @retry_policy()
     def make_request(self, method, endpoint, **kwargs):
-        response = requests.request(method, endpoint, headers=self.headers, timeout=30, **kwargs)
+        response = get_session().request(method, endpoint, headers=self.headers, timeout=30, **kwargs)
         response.raise_for_status()
 
         try:
@@ -50,24 +55,308 @@ class PACSClient(object):
         CUBE instance
         """
         query_string = urlencode(params)
-        response = self.make_request("GET",f"{self.pacs_series_url}/search/?{query_string}")
+        response = self.make_request("GET", f"{self.pacs_series_url}/search/?{query_string}")
         if response:
+            for item in items(response):
+                self._remember_folder(self._item_data(item))
             return response.get("collection", {}).get("total", [])
         raise Exception(f"No PACS details with matching search criteria {params}")
 
     def get_pacs_files(self, params: dict):
         """
-        Get PACS folder path
+        Get PACS folder path.
+        Paths already seen by a registration lookup are served from the
+        folder cache without a request.
         """
+        series_instance = params.get("SeriesInstanceUID")
+        if series_instance in self._folder_cache:
+            return self._folder_cache[series_instance]
+
         l_dir_path = set()
         query_string = urlencode(params)
         response = self.make_request("GET", f"{self.pacs_series_url}/search/?{query_string}")
-        for item in response.get("collection", {}).get("items", []):
-            for link in item.get("links", []):
-                folder = self.make_request("GET",link.get("href"))
-                for item_folder in folder.get("collection", {}).get("items", []):
-                    for field in item_folder.get("data", []):
-                        if field.get("name") == "path":
-                            l_dir_path.add(field.get("value"))
-
-        return ','.join(l_dir_path)
\ No newline at end of file
+        for item in items(response):
+            path = self._series_folder(item)
+            if path:
+                l_dir_path.add(path)
+
+        return ','.join(l_dir_path)
+
+    def get_series_file_count(self, series_instance: str) -> int:
+        """
+        Number of files of a series registered to CUBE so far.
+        """
+        query_string = urlencode({"SeriesInstanceUID": series_instance, "limit": 1})
+        response = self.make_request("GET", f"{self.api_base}/pacs/files/search/?{query_string}")
+        return int(response.get("collection", {}).get("total", 0) or 0)
+
+    def get_study_registration(self, study_instance: str, series_instances: set = None) -> dict:
+        """
+        Look up every PACS series of a study registered to CUBE with a
+        single (paged) search, and return registration status and folder
+        path per SeriesInstanceUID. If ``series_instances`` is given, the
+        result covers exactly those series, unregistered ones included.
+        """
+        status = {}
+        query_string = urlencode({"StudyInstanceUID": study_instance, "limit": 100})
+        endpoint = f"{self.pacs_series_url}/search/?{query_string}"
+
+        while endpoint:
+            response = self.make_request("GET", endpoint)
+            collection = response.get("collection", {})
+            for item in items(response):
+                data = self._item_data(item)
+                series_instance = data.get("SeriesInstanceUID")
+                if series_instances is not None and series_instance not in series_instances:
+                    continue
+                status[series_instance] = {"registered": True, "path": self._series_folder(item, data)}
+            endpoint = self._next_page(collection)
+
+        for series_instance in series_instances or ():
+            status.setdefault(series_instance, {"registered": False, "path": ""})
+        return status
+
+    @staticmethod
+    def _next_page(collection: dict):
+        for link in collection.get("links", []):
+            if link.get("rel") == "next":
+                return link.get("href")
+        return None
+
+    @staticmethod
+    def _item_data(item: dict) -> dict:
+        return item_record(item, SERIES_ITEM_FIELDS)
+
+    def _remember_folder(self, data: dict) -> str:
+        """
+        Memoize the folder path carried by a series item, if any.
+        """
+        path = data.get("folder_path")
+        if path and data.get("SeriesInstanceUID"):
+            self._folder_cache[data["SeriesInstanceUID"]] = path
+        return path or ""
+
+    def _series_folder(self, item: dict, data: dict = None) -> str:
+        """
+        Resolve the folder path of a PACS series item: from the memoized
+        paths, from its ``folder_path`` field, or as a last resort by
+        following its ``folder`` link.
+        """
+        data = data if data is not None else self._item_data(item)
+        series_instance = data.get("SeriesInstanceUID")
+        if series_instance in self._folder_cache:
+            return self._folder_cache[series_instance]
+        path = self._remember_folder(data)
+        if not path:
+            path = self._get_folder_path(item)
+            if path and series_instance:
+                self._folder_cache[series_instance] = path
+        return path
+
+    def _get_folder_path(self, item: dict) -> str:
+        """
+        Follow the ``folder`` link of a PACS series item to its path.
+        """
+        for link in item.get("links", []):
+            if link.get("rel") == "folder":
+                return self._folder_path(self.make_request("GET", link.get("href")))
+        return ""
+
+    @staticmethod
+    def _folder_path(folder: dict) -> str:
+        return first_value(folder, "path", "")
+
+
+class AsyncPACSClient(PACSClient):
+    """
+    Non-blocking variant of ``PACSClient`` on the shared aiohttp session,
+    which also serves the watermark lookups of ``AsyncSeriesWatcher``.
+    """
+
+    # --------------------------
+    # Retryable request handler
+    # --------------------------
+    @async_retry_policy()
+    async def make_request(self, method, endpoint, **kwargs):
+        return await async_request(method, endpoint, headers=self.headers, **kwargs)
+
+    async def get_pacs_registered(self, params: dict):
+        """
+        Get the list of PACS series registered to _this_
+        CUBE instance
+        """
+        query_string = urlencode(params)
+        response = await self.make_request("GET", f"{self.pacs_series_url}/search/?{query_string}")
+        if response:
+            for item in items(response):
+                self._remember_folder(self._item_data(item))
+            return response.get("collection", {}).get("total", [])
+        raise Exception(f"No PACS details with matching search criteria {params}")
+
+    async def get_pacs_files(self, params: dict):
+        """
+        Get PACS folder path.
+        Paths already seen by a registration lookup are served from the
+        folder cache without a request.
+        """
+        series_instance = params.get("SeriesInstanceUID")
+        if series_instance in self._folder_cache:
+            return self._folder_cache[series_instance]
+
+        l_dir_path = set()
+        query_string = urlencode(params)
+        response = await self.make_request("GET", f"{self.pacs_series_url}/search/?{query_string}")
+        for item in items(response):
+            path = await self._series_folder(item)
+            if path:
+                l_dir_path.add(path)
+
+        return ','.join(l_dir_path)
+
+    async def get_series_file_count(self, series_instance: str) -> int:
+        """
+        Number of files of a series registered to CUBE so far.
+        """
+        query_string = urlencode({"SeriesInstanceUID": series_instance, "limit": 1})
+        response = await self.make_request("GET", f"{self.api_base}/pacs/files/search/?{query_string}")
+        return int(response.get("collection", {}).get("total", 0) or 0)
+
+    async def get_study_registration(self, study_instance: str, series_instances: set = None) -> dict:
+        """
+        Look up every PACS series of a study registered to CUBE with a
+        single (paged) search, and return registration status and folder
+        path per SeriesInstanceUID. If ``series_instances`` is given, the
+        result covers exactly those series, unregistered ones included.
+        """
+        status = {}
+        query_string = urlencode({"StudyInstanceUID": study_instance, "limit": 100})
+        endpoint = f"{self.pacs_series_url}/search/?{query_string}"
+
+        while endpoint:
+            response = await self.make_request("GET", endpoint)
+            collection = response.get("collection", {})
+            for item in items(response):
+                data = self._item_data(item)
+                series_instance = data.get("SeriesInstanceUID")
+                if series_instances is not None and series_instance not in series_instances:
+                    continue
+                status[series_instance] = {"registered": True, "path": await self._series_folder(item, data)}
+            endpoint = self._next_page(collection)
+
+        for series_instance in series_instances or ():
+            status.setdefault(series_instance, {"registered": False, "path": ""})
+        return status
+
+    async def _series_folder(self, item: dict, data: dict = None) -> str:
+        """
+        Resolve the folder path of a PACS series item: from the memoized
+        paths, from its ``folder_path`` field, or as a last resort by
+        following its ``folder`` link.
+        """
+        data = data if data is not None else self._item_data(item)
+        series_instance = data.get("SeriesInstanceUID")
+        if series_instance in self._folder_cache:
+            return self._folder_cache[series_instance]
+        path = self._remember_folder(data)
+        if not path:
+            path = await self._get_folder_path(item)
+            if path and series_instance:
+                self._folder_cache[series_instance] = path
+        return path
+
+    async def _get_folder_path(self, item: dict) -> str:
+        """
+        Follow the ``folder`` link of a PACS series item to its path.
+        """
+        for link in item.get("links", []):
+            if link.get("rel") == "folder":
+                return self._folder_path(await self.make_request("GET", link.get("href")))
+        return ""
+
+    async def get_latest_series_marker(self) -> dict:
+        """
+        Get the ``id`` and ``creation_date`` of the newest PACS series
+        registered to CUBE, to be used as a watermark for
+        ``get_registered_since``.
+        """
+        response = await self.make_request("GET", f"{self.pacs_series_url}/?limit=1")
+        for item in items(response):
+            return self._series_marker(item)
+        return {}
+
+    async def get_registered_since(self, watermark: dict, pending: set) -> tuple[set, dict]:
+        """
+        Page through PACS series newest-first, down to ``watermark``, and
+        return the SeriesInstanceUIDs of ``pending`` that were registered
+        since, together with the new watermark.
+        """
+        registered = set()
+        newest = watermark
+        endpoint = self._since_endpoint(watermark)
+
+        while endpoint:
+            response = await self.make_request("GET", endpoint)
+            endpoint, newest = self._scan_since(response, watermark, newest, pending, registered)
+
+        return registered, self._watermark(newest)
+
+    def _since_endpoint(self, watermark: dict) -> str:
+        query = {"limit": 100}
+        if watermark.get("creation_date"):
+            query["min_creation_date"] = watermark["creation_date"]
+        return f"{self.pacs_series_url}/search/?{urlencode(query)}"
+
+    def _scan_since(self, response: dict, watermark: dict, newest: dict, pending: set, registered: set):
+        """
+        Scan one newest-first page, adding pending series to ``registered``.
+        Returns the next page to fetch (``None`` once the watermark is
+        reached) and the newest series seen so far.
+        """
+        collection = response.get("collection", {})
+        for item in items(response):
+            marker = self._series_marker(item)
+            if marker.get("id", 0) <= watermark.get("id", 0):
+                return None, newest
+            if marker.get("id", 0) > newest.get("id", 0):
+                newest = marker
+            if marker.get("SeriesInstanceUID") in pending:
+                registered.add(marker["SeriesInstanceUID"])
+                self._remember_folder(self._item_data(item))
+        return self._next_page(collection), newest
+
+    @staticmethod
+    def _watermark(marker: dict) -> dict:
+        return {key: marker[key] for key in ("id", "creation_date") if key in marker}
+
+    @staticmethod
+    def _series_marker(item: dict) -> dict:
+        return item_record(item, MARKER_FIELDS)
+
+
+class AsyncSeriesWatcher(object):
+    """
+    Watch CUBE for newly registered PACS series using an incremental
+    ``id``/``creation_date`` watermark, so that one sweep of list requests
+    covers every pending series instead of one search per series.
+    """
+
+    def __init__(self, client: AsyncPACSClient):
+        self.client = client
+        self.watermark: dict = {}
+        self.registered: set = set()
+
+    async def prime(self):
+        """
+        Move the watermark to the newest series currently in CUBE. Series
+        registered before this point have to be looked up directly.
+        """
+        self.watermark = await self.client.get_latest_series_marker()
+
+    async def sweep(self, pending: set) -> set:
+        """
+        Mark every series of ``pending`` registered since the last sweep.
+        """
+        found, self.watermark = await self.client.get_registered_since(self.watermark, pending)
+        self.registered.update(found)
+        LOG(f"{len(found)} newly registered series found in CUBE.")
+        return found
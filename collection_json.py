@@ -0,0 +1,57 @@
+### Collection+JSON Parsing ###
+
+
+class Record(dict):
+    """
+    Fields of a collection item by name, also readable as attributes.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def items(response) -> list:
+    """
+    Items of a CUBE Collection+JSON response. ``response`` may be the full
+    response or its item list already.
+    """
+    if isinstance(response, dict):
+        return response.get("collection", {}).get("items", [])
+    return response or []
+
+
+def item_record(item: dict, fields: frozenset = None) -> Record:
+    """
+    ``Record`` of one item, restricted to ``fields`` if given.
+    """
+    if fields is None:
+        return Record({field.get("name"): field.get("value") for field in item.get("data", ())})
+    return Record({name: field.get("value") for field in item.get("data", ())
+                   if (name := field.get("name")) in fields})
+
+
+def records(response, fields=None) -> list[Record]:
+    """
+    Records of every item of ``response`` in a single pass, keeping only
+    ``fields`` if given.
+    """
+    if fields is not None:
+        fields = frozenset(fields)
+    return [item_record(item, fields) for item in items(response)]
+
+
+def first_value(response, name: str, default=None):
+    """
+    Value of the first ``name`` field of ``response``; stops at the first
+    match without parsing the remaining fields.
+    """
+    for item in items(response):
+        for field in item.get("data", ()):
+            if field.get("name") == name:
+                return field.get("value")
+    return default
@@ -2,18 +2,25 @@
 
 from pathlib import Path
 from argparse import ArgumentParser, Namespace, ArgumentDefaultsHelpFormatter
-from chris_pacs_service import PACSClient
+from chris_pacs_service import AsyncPACSClient
 from loguru import logger
 from chris_plugin import chris_plugin, PathMapper
-from chrisClient import ChrisClient
-import time
+from chrisClient import ChrisClient, AsyncChrisClient
+from registration_scheduler import RegistrationScheduler
+from series_table import SeriesTable
+from metadata_cache import MetadataCache
+from registration_stats import RegistrationStats
+from workflow_monitor import WorkflowMonitor, JobBudget, series_status
+from series_stream import SeriesStream, iter_records
+from run_journal import RunJournal, JOURNAL_FILE, RUNNING_STATUS
 import json
-import copy
 import sys
 import os
-import pfdcm
-import copy
 import asyncio
+import http_session
+import governor
+import parallel
+from functools import partial
 
 LOG = logger.debug
 
@@ -105,17 +112,85 @@ parser.add_argument(
     '--pollInterval',
     default=5,
     type=int,
-    help='wait time in seconds before the next poll'
+    help='base wait time in seconds before the next poll'
 )
 parser.add_argument(
     '--maxPoll',
     default=50,
     type=int,
-    help='max number of times to poll before error out'
+    help='max number of poll intervals without registration progress before error out'
+)
+parser.add_argument(
+    '--maxConcurrency',
+    default=8,
+    type=int,
+    help='max number of series polled or submitted concurrently'
+)
+parser.add_argument(
+    '--maxJobs',
+    default=0,
+    type=int,
+    help='max number of jobs of the started workflows scheduled or running in CUBE before new workflows are held (0 for no limit)'
+)
+parser.add_argument(
+    '--watch',
+    help='detect newly registered series with one incremental list query per poll cycle',
+    dest='watch',
+    action='store_true',
+    default=False
+)
+parser.add_argument(
+    '--batchStudies',
+    dest='batchStudies',
+    action='store_true',
+    default=False,
+    help='anonymize the registered series of a study together, with one dsdircopy instance and one workflow'
+)
+parser.add_argument(
+    '--batchWait',
+    default=300,
+    type=int,
+    help='max seconds a registered series waits for the rest of its study with --batchStudies'
+)
+parser.add_argument(
+    '--pfdcmJobs',
+    default=4,
+    type=int,
+    help='max number of retry retrieve jobs in progress in pfdcm at a time'
+)
+parser.add_argument(
+    '--poolSize',
+    default=20,
+    type=int,
+    help='max number of pooled keep-alive connections per host'
+)
+parser.add_argument(
+    '--requestRate',
+    default=50,
+    type=float,
+    help='max requests per second sent to each of CUBE and pfdcm (0 for no limit); concurrency adapts to their load'
+)
+parser.add_argument(
+    '--metadataCache',
+    default='',
+    type=str,
+    help='JSON file to persist CUBE pipeline/plugin metadata across runs (in memory only if empty)'
+)
+parser.add_argument(
+    '--registrationStats',
+    default='',
+    type=str,
+    help='JSON file to keep registration times across runs, used to time the first poll of a series'
+)
+parser.add_argument(
+    '--metadataTTL',
+    default=3600,
+    type=int,
+    help='seconds before cached CUBE metadata is fetched again'
 )
 parser.add_argument(
     "--inNode",
-    help="perform in-node implicit parallelization in conjunction with --thread",
+    help="spread series over worker processes (combine with --thread to also use threads in each)",
     dest="inNode",
     action="store_true",
     default=False,
@@ -127,6 +202,19 @@ parser.add_argument(
     action="store_true",
     default=False,
 )
+parser.add_argument(
+    '--stream',
+    dest='stream',
+    action='store_true',
+    default=False,
+    help='read input JSON files incrementally and poll each series as soon as it is read (ignores --thread/--inNode)'
+)
+parser.add_argument(
+    '--numWorkers',
+    default=0,
+    type=int,
+    help='number of threads (--thread) or processes (--inNode) to spread series over; 0 uses every CPU allowed by the CPU affinity and cgroup quota'
+)
 parser.add_argument(
     '--recipients',
     default='',
@@ -177,26 +265,72 @@ def main(options: Namespace, inputdir: Path, outputdir: Path):
     # adding a progress bar and parallelism.
     log_file = os.path.join(outputdir, 'terminal.log')
     logger.add(log_file)
+    http_session.configure(pool_maxsize=options.poolSize)
+    governor.configure(rate=options.requestRate, max_concurrency=options.poolSize)
     if not health_check(options): return
 
-    cube_cl = PACSClient(options.CUBEurl, options.CUBEtoken)
     mapper = PathMapper.file_mapper(inputdir, outputdir, glob=options.inputJSONfile)
-    for input_file, output_file in mapper:
+    if options.stream:
+        file_pairs = list(mapper)
+        registration_errors, outcomes = run_stream(options, SeriesStream([input_file for input_file, _ in file_pairs]))
+        file_pairs = [(iter_records(input_file), output_file) for input_file, output_file in file_pairs]
+    else:
+        file_pairs, data = load_work_set(mapper)
+        if options.inNode or options.thread:
+            registration_errors, outcomes = run_parallel(options, data)
+        else:
+            registration_errors, outcomes = run_shard(options, data)
 
+    for records, output_file in file_pairs:
+        write_outcomes(output_file, records, outcomes)
+
+    if registration_errors:
+        LOG(f"ERROR while running pipelines.")
+        sys.exit(1)
+
+def load_work_set(mapper) -> tuple[list, list]:
+    """
+    Read every input JSON file. Returns the records of each file with its
+    output file, and one work set of all series in which a
+    SeriesInstanceUID listed by several files appears once.
+    """
+    file_pairs = []
+    work_set = {}
+    for input_file, output_file in mapper:
         # Open and read the JSON file
         with open(input_file, 'r') as file:
             data = json.load(file)
 
-            # null check
-            if len(data) == 0:
-                raise Exception(f"Cannot verify registration for empty pacs data.")
+        # null check
+        if len(data) == 0:
+            raise Exception(f"Cannot verify registration for empty pacs data.")
 
-            retry_table = create_hash_table(data, 5)
-            registration_errors = asyncio.run(check_registration(options, retry_table, cube_cl))
+        file_pairs.append((data, output_file))
+        for series in data:
+            work_set.setdefault(series["SeriesInstanceUID"], series)
 
-            if registration_errors:
-                LOG(f"ERROR while running pipelines.")
-                sys.exit(1)
+    total = sum(len(records) for records, _ in file_pairs)
+    if total > len(work_set):
+        LOG(f"Dropped {total - len(work_set)} duplicate series across {len(file_pairs)} input files.")
+    return file_pairs, list(work_set.values())
+
+def write_outcomes(output_file: Path, records, outcomes: dict):
+    """
+    Write the records of one input file, with the outcome of each series,
+    to its output file. ``records`` may be any iterable; it is written
+    one record at a time.
+    """
+    unknown = {"status": "not processed", "workflow_id": None}
+    with open(output_file, 'w', encoding='utf-8') as outf:
+        outf.write('[')
+        separator = '\n'
+        for series in records:
+            if not isinstance(series, dict):
+                continue
+            result = {**series, **outcomes.get(series.get("SeriesInstanceUID"), unknown)}
+            outf.write(separator + json.dumps(result))
+            separator = ',\n'
+        outf.write('\n]\n')
 
 def sanitize_for_cube(series: dict) -> dict:
     """
@@ -226,112 +360,197 @@ def health_check(options) -> bool:
         return False
     return True
 
-def create_hash_table(retrieve_data: dict, retry: int) -> dict:
-    retry_table: dict = {}
+def create_hash_table(retrieve_data: list, retry: int) -> SeriesTable:
+    retry_table = SeriesTable()
     for series in retrieve_data:
-        retry_table[series["SeriesInstanceUID"]] = {}
-        retry_table[series["SeriesInstanceUID"]]["retry"] = retry
-        retry_table[series["SeriesInstanceUID"]]["SeriesInstanceUID"] = series["SeriesInstanceUID"]
-        retry_table[series["SeriesInstanceUID"]]["StudyInstanceUID"] = series["StudyInstanceUID"]
-        retry_table[series["SeriesInstanceUID"]]["AccessionNumber"] = series["AccessionNumber"]
-        retry_table[series["SeriesInstanceUID"]]["PatientID"] = series["PatientID"]
-        retry_table[series["SeriesInstanceUID"]]["StudyDate"] = series["StudyDate"]
-        retry_table[series["SeriesInstanceUID"]]["Modality"] = series["Modality"]
-        retry_table[series["SeriesInstanceUID"]]["NumberOfSeriesRelatedInstances"] = series["NumberOfSeriesRelatedInstances"]
+        retry_table.add(series, retry)
 
     return retry_table
 
-def get_max_poll(file_count, default_poll: int) -> int:
+def run_parallel(options: Namespace, data: list) -> tuple[bool, dict]:
     """
-    Adjust polling to CUBE based on number of series-related instances
+    Spread the series of ``data`` over ``options.numWorkers`` processes
+    (``--inNode``) or threads (``--thread``), keeping each study in one
+    shard. Every shard runs its own ``check_registration`` on its own
+    event loop. Returns whether any shard failed, and the outcome of
+    every series.
     """
-
-    MAX_POLL = 50
-
-    # Ensure file_count is an integer
+    workers = options.numWorkers or parallel.default_workers()
+    if options.inNode and options.maxJobs:
+        # the job ceiling is split between processes; leave each room for a whole workflow
+        workers = min(workers, max(1, options.maxJobs // workflow_size(options)))
+    shards = parallel.shard_series(data, workers)
+    running = max(1, min(workers, len(shards)))
+    if options.inNode:
+        # every process governs its own requests and workflow jobs; split the limits between them
+        options = Namespace(**{**vars(options), "numWorkers": workers,
+                               "maxJobs": options.maxJobs // running if options.maxJobs else 0,
+                               "requestRate": options.requestRate / running,
+                               "poolSize": max(1, options.poolSize // running)})
+    stats = RegistrationStats(options.registrationStats)
+    if options.inNode:
+        results = parallel.map_processes(partial(run_node_shard, options), shards, workers)
+        outcomes = {}
+        for _, shard_outcomes, observations in results:
+            outcomes.update(shard_outcomes)
+            stats.merge(observations)
+        stats.save()
+        return any(errors for errors, _, _ in results), outcomes
+
+    cache = MetadataCache(options.metadataCache, options.metadataTTL)
     try:
-        file_count = int(file_count)
-    except (TypeError, ValueError):
-        raise TypeError(f"Expected int for file_count argument, got {file_count!r}")
+        return run_threads(options, shards, workers, cache, stats)
+    finally:
+        cache.save()
+        stats.save()
 
-    # Compute polls based on file count
-    polls = default_poll if file_count < 200 else default_poll * (file_count // 200)
+def workflow_size(options: Namespace) -> int:
+    """
+    Jobs of one anonymization workflow, or 1 if CUBE cannot tell.
+    """
+    cache = MetadataCache(options.metadataCache, options.metadataTTL)
 
-    # Cap polls to MAX_POLL
-    final_polls = min(polls, MAX_POLL)
+    async def fetch():
+        try:
+            return await AsyncChrisClient(options.CUBEurl, options.CUBEtoken, cache).workflow_jobs()
+        finally:
+            await http_session.close_async_session()
 
-    # Log if poll increased due to file count or was capped
-    if final_polls != default_poll:
-        if final_polls > MAX_POLL:
-            LOG(f"Polling capped at {MAX_POLL} (computed={polls}, files={file_count})")
-        else:
-            LOG(f"Polling increased from {default_poll} → {final_polls} due to large file count ({file_count} files)")
+    try:
+        return max(1, asyncio.run(fetch()))
+    except Exception as ex:
+        LOG(f"Could not fetch the size of the anonymization workflow: {ex}")
+        return 1
+    finally:
+        cache.save()
 
-    return final_polls
+def run_threads(options: Namespace, shards: list, workers: int, cache: MetadataCache,
+                stats: RegistrationStats) -> tuple[bool, dict]:
+    """
+    Check registration of every shard in a bounded thread pool. The
+    shards share one ``options.maxJobs`` ceiling on workflow jobs.
+    """
+    budget = JobBudget(options.maxJobs)
+    results = parallel.map_threads(partial(run_shard, options, cache=cache, stats=stats, budget=budget),
+                                   shards, workers)
+    outcomes = {}
+    for _, shard_outcomes in results:
+        outcomes.update(shard_outcomes)
+    return any(errors for errors, _ in results), outcomes
+
+def run_shard(options: Namespace, records: list, cache: MetadataCache = None,
+              stats: RegistrationStats = None, budget: JobBudget = None) -> tuple[bool, dict]:
+    """
+    Check registration of a list of series on a new event loop. Returns
+    whether any series failed, and the outcome of every series.
+    """
+    client = AsyncPACSClient(options.CUBEurl, options.CUBEtoken)
+    retry_table = create_hash_table(records, 5)
+    registration_errors = asyncio.run(check_registration(options, retry_table, client, cache, stats,
+                                                         budget=budget))
+    return registration_errors, retry_table.outcomes()
 
+def run_stream(options: Namespace, stream: SeriesStream) -> tuple[bool, dict]:
+    """
+    Check registration of the series of ``stream`` as they are read.
+    Returns whether any series failed or was invalid, and the outcome of
+    every series.
+    """
+    client = AsyncPACSClient(options.CUBEurl, options.CUBEtoken)
+    retry_table = SeriesTable()
+    registration_errors = asyncio.run(check_registration(options, retry_table, client,
+                                                         source=add_to_table(stream, retry_table, 5)))
+    return registration_errors or stream.invalid > 0, retry_table.outcomes()
 
+async def add_to_table(source, retry_table: SeriesTable, retry: int):
+    """
+    Add each record of the async iterable ``source`` to ``retry_table``
+    and yield its series state.
+    """
+    async for record in source:
+        yield retry_table.add(record, retry)
 
-# Recursive method to check on registration and then run anonymization pipeline
-async def check_registration(options: Namespace, retry_table: dict, client: PACSClient, contains_errors: bool=False):
+def run_node_shard(options: Namespace, records: list) -> tuple[bool, dict, list]:
+    """
+    Entry point of an ``--inNode`` worker process. With ``--thread`` the
+    shard is split again over threads. Returns the error flag, the series
+    outcomes and the registration times observed, merged into the stats
+    by the parent.
+    """
+    http_session.configure(pool_maxsize=options.poolSize)
+    governor.configure(rate=options.requestRate, max_concurrency=options.poolSize)
+    cache = MetadataCache(options.metadataCache, options.metadataTTL)
+    stats = RegistrationStats(options.registrationStats)
+    try:
+        if options.thread:
+            threads = parallel.threads_per_process(options.numWorkers or parallel.default_workers())
+            errors, outcomes = run_threads(options, parallel.shard_series(records, threads), threads, cache, stats)
+        else:
+            errors, outcomes = run_shard(options, records, cache, stats)
+    finally:
+        cache.save()
+    return errors, outcomes, stats.recorded
+
+async def check_registration(options: Namespace, retry_table: SeriesTable, client: AsyncPACSClient,
+                             cache: MetadataCache = None, stats: RegistrationStats = None, source=None,
+                             budget: JobBudget = None) -> bool:
+    """
+    Poll CUBE for every series of ``retry_table`` and run the anonymization
+    pipeline on each series as soon as it is registered.
+
+    Series are driven by a ``RegistrationScheduler`` that keeps them in a
+    priority queue ordered by next poll time; ``options.maxConcurrency``
+    bounds the number of series being worked on at any time. Workflows
+    started along the way are tracked by a ``WorkflowMonitor`` until they
+    finish; new workflows are held while ``options.maxJobs`` of their jobs
+    are scheduled or running.
+    Returns ``True`` if any series or workflow failed.
+
+    ``cache`` and ``stats`` may be shared between calls; the caller then
+    saves them. Otherwise they are loaded and saved here. Series states
+    yielded by the async iterable ``source`` are scheduled as they arrive.
+    ``budget`` shares the ``options.maxJobs`` ceiling with calls running
+    in other threads.
+    """
     # null check
-    if len(retry_table) == 0:
-        return contains_errors
-
-    clone_retry_table = copy.deepcopy(retry_table)
-
-    for series_instance in retry_table.keys():
-        LOG(f"Polling CUBE for series: {series_instance}.")
-        registered_series_count = client.get_pacs_registered({'SeriesInstanceUID':series_instance})
-
-        file_count: int = retry_table[series_instance]["NumberOfSeriesRelatedInstances"]
-
-        # poll CUBE at regular interval for the status of file registration
-        poll_count: int = 0
-        total_polls: int = get_max_poll(file_count, options.maxPoll)
-        wait_poll: int = options.pollInterval
-        while registered_series_count < 1 and poll_count < total_polls:
-            poll_count += 1
-            time.sleep(wait_poll)
-            registered_series_count = client.get_pacs_registered({'SeriesInstanceUID':series_instance})
-            LOG(f"{registered_series_count} series found in CUBE.")
-
-        # check if polling timed out before registration is finished
-        if registered_series_count == 0 and clone_retry_table[series_instance]["retry"] > 0:
-            LOG(f"PACS series registration unsuccessful. Retrying retrieve for {series_instance}.")
-            # retry retrieve
-            retrieve_response = pfdcm.retrieve_pacsfiles(retry_table[series_instance],
-                                                         options.PACSurl, options.PACSname)
-
-            # save retry file
-            srs_json_file_path = os.path.join(options.outputdir,
-                                                  f"{series_instance}_retrieve_retry_{clone_retry_table[series_instance]["retry"]}.json")
-            clone_retry_table[series_instance]["retry"] -= 1
-            with open(srs_json_file_path, 'w', encoding='utf-8') as jsonf:
-                jsonf.write(json.dumps(retrieve_response, indent=4))
-            continue
-
-        if registered_series_count:
-            LOG(f"Series {series_instance} successfully registered to CUBE.")
-            send_params = {
-                "neuro_dcm_location": options.neuroDicomLocation,
-                "neuro_anon_location": options.neuroAnonLocation,
-                "neuro_nifti_location": options.neuroNiftiLocation,
-                "folder_name": options.folderName,
-                "recipients": options.recipients,
-                "smtp_server": options.SMTPServer
-            }
-            dicom_dir = client.get_pacs_files({'SeriesInstanceUID': series_instance})
-            series_data = json.dumps(retry_table[series_instance])
-
-            # create ChRIS Client Object
-            cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken)
-            d_ret = await cube_con.anonymize(dicom_dir, send_params, options.pluginInstanceID, series_data)
-            if d_ret.get('error'):
-                contains_errors = True
-        clone_retry_table.pop(series_instance)
-
-    await check_registration(options, clone_retry_table, client, contains_errors)
-    return contains_errors
+    if len(retry_table) == 0 and source is None:
+        return False
+
+    own_cache, own_stats = cache is None, stats is None
+    if own_cache:
+        cache = MetadataCache(options.metadataCache, options.metadataTTL)
+    if own_stats:
+        stats = RegistrationStats(options.registrationStats)
+    cube_con = AsyncChrisClient(options.CUBEurl, options.CUBEtoken, cache)
+    journal = RunJournal(os.path.join(options.outputdir, JOURNAL_FILE))
+    monitor = WorkflowMonitor(cube_con.pipeline, options.pollInterval, max_jobs=options.maxJobs, journal=journal,
+                              budget=budget)
+    cube_con.pipeline.monitor = monitor
+    scheduler = RegistrationScheduler(options, client, cube_con, stats, journal, monitor)
+    for series in retry_table.values():
+        scheduler.add(series)
+    monitor_task = asyncio.create_task(monitor.run())
+    # fetch CUBE metadata while the first series are read and polled; concurrent lookups share the fetch
+    warm_up_task = asyncio.create_task(cube_con.warm_up())
+    try:
+        contains_errors = await scheduler.run(source)
+        monitor.close()
+        await monitor_task
+        # report how the workflows ended rather than that they were started
+        for series in retry_table.values():
+            outcome = monitor.outcomes.get(series.workflow_id)
+            if series.status == RUNNING_STATUS and outcome is not None:
+                series.status = series_status(outcome)
+        return contains_errors or bool(monitor.failed)
+    finally:
+        monitor_task.cancel()
+        warm_up_task.cancel()
+        journal.close()
+        if own_cache:
+            cache.save()
+        if own_stats:
+            stats.save()
+        await http_session.close_async_session()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,187 @@
+### Request Governor Implementation ###
+
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+from loguru import logger
+
+LOG = logger.debug
+
+# Requests per second allowed to one host by default; 0 disables the token bucket
+DEFAULT_RATE = 50
+# Upper bound of the adaptive concurrency limit per host
+DEFAULT_MAX_CONCURRENCY = 20
+# A response slower than this many times the baseline latency signals congestion
+LATENCY_FACTOR = 3
+# Responses faster than this never count as congested, in seconds
+LATENCY_FLOOR = 1.0
+
+_governors: dict = {}
+_lock = threading.Lock()
+_settings = {
+    "rate": DEFAULT_RATE,
+    "max_concurrency": DEFAULT_MAX_CONCURRENCY,
+}
+
+
+class HostGovernor:
+    """
+    Process-wide admission control for the requests sent to one host.
+
+    * A token bucket caps the request rate at ``rate`` per second, with
+      bursts of up to one second's worth of tokens. A ``Retry-After``
+      header pauses the bucket.
+    * An AIMD concurrency limit bounds the requests in flight: it grows
+      by one per limit's worth of fast successful responses, shrinks by
+      10% when latency climbs well above its baseline, and halves on
+      429, 5xx and transport errors.
+
+    Blocking and async callers share the same counters, so the limits
+    hold across threads and event loops.
+    """
+
+    def __init__(self, host: str, rate: float = DEFAULT_RATE, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.host = host
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.max_limit = max(1, max_concurrency)
+        self.limit = max(1.0, self.max_limit / 2)
+        self.in_flight = 0
+        self.baseline = None
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        # futures of async callers waiting for a slot, with their event loops
+        self._waiters = []
+
+    def _try_acquire(self):
+        """
+        Take a slot and a token if both are available. Returns 0 on
+        success, the seconds until a token is due, or ``None`` if every
+        slot is taken.
+        """
+        with self._cond:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.in_flight >= int(self.limit):
+                return None
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens < 1:
+                    return (1 - self._tokens) / self.rate
+                self._tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if wait == 0:
+                return
+            if wait is None:
+                with self._cond:
+                    self._cond.wait(timeout=0.1)
+            else:
+                time.sleep(wait)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+                if wait is None:
+                    waiter = loop.create_future()
+                    self._waiters.append((loop, waiter))
+            if wait == 0:
+                return
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await waiter
+            finally:
+                with self._cond:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    def release(self, latency: float, status: int = None, error: bool = False, retry_after=None,
+                adapt: bool = True):
+        """
+        Return a slot and, unless ``adapt`` is false (e.g. the request was
+        cancelled), adapt the limits to the outcome of the request.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            self._wake_waiters()
+            if not adapt:
+                return
+            if error or status == 429 or (status is not None and status >= 500):
+                self.limit = max(1.0, self.limit / 2)
+                LOG(f"{self.host}: overloaded ({status or 'transport error'}), "
+                    f"concurrency limit down to {int(self.limit)}.")
+            elif self.baseline is not None and latency > max(LATENCY_FLOOR, LATENCY_FACTOR * self.baseline):
+                self.limit = max(1.0, self.limit * 0.9)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            if not error:
+                # follows new minima at once, drifts up slowly
+                self.baseline = latency if self.baseline is None else min(
+                    latency, self.baseline + 0.01 * (latency - self.baseline))
+            seconds = _parse_retry_after(retry_after)
+            if seconds:
+                self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+    def _wake_waiters(self):
+        """
+        Wake every async caller waiting for a slot, on its own event loop.
+        Called with ``_cond`` held.
+        """
+        waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # the waiter's event loop is closed
+                pass
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _parse_retry_after(value):
+    try:
+        return min(float(value), 60.0) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def configure(rate: float = DEFAULT_RATE, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+    """
+    Set the limits of the per-host governors created from now on.
+    """
+    with _lock:
+        _settings.update(rate=rate, max_concurrency=max_concurrency)
+        _governors.clear()
+
+
+def for_url(url: str) -> HostGovernor:
+    """
+    The governor of the host ``url`` points to.
+    """
+    host = urlsplit(url).netloc
+    governor = _governors.get(host)
+    if governor is None:
+        with _lock:
+            governor = _governors.get(host)
+            if governor is None:
+                governor = HostGovernor(host, _settings["rate"], _settings["max_concurrency"])
+                _governors[host] = governor
+    return governor
@@ -0,0 +1,182 @@
+### Shared HTTP Transport ###
+
+import json
+import time
+import asyncio
+import threading
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, Timeout, HTTPError
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
+from urllib3.util.retry import Retry
+
+import governor
+
+# Number of distinct hosts to keep connection pools for
+POOL_CONNECTIONS = 10
+# Max connections kept alive (and in flight) per host
+POOL_MAXSIZE = 20
+# Connection-level retries done by urllib3 before tenacity sees an error
+CONNECT_RETRIES = 2
+
+# Seconds before an async request is abandoned
+REQUEST_TIMEOUT = 30
+
+_session = None
+# one aiohttp session per thread, as each thread runs its own event loop
+_local = threading.local()
+_lock = threading.Lock()
+_settings = {
+    "pool_connections": POOL_CONNECTIONS,
+    "pool_maxsize": POOL_MAXSIZE,
+    "connect_retries": CONNECT_RETRIES,
+}
+
+
+def retry_policy(attempts: int = 5):
+    """
+    Retry policy shared by every client request handler.
+    """
+    return retry(
+        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
+        wait=wait_exponential(multiplier=1, min=2, max=10),
+        stop=stop_after_attempt(attempts),
+        reraise=True
+    )
+
+
+def async_retry_policy(attempts: int = 5):
+    """
+    Retry policy for the async request handlers, with the same back-off
+    as ``retry_policy``.
+    """
+    return retry(
+        retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError)),
+        wait=wait_exponential(multiplier=1, min=2, max=10),
+        stop=stop_after_attempt(attempts),
+        reraise=True
+    )
+
+
+def configure(pool_connections: int = POOL_CONNECTIONS, pool_maxsize: int = POOL_MAXSIZE,
+              connect_retries: int = CONNECT_RETRIES):
+    """
+    Tune the shared connection pool. Takes effect for the next session,
+    so call it before the first request.
+    """
+    global _session
+    with _lock:
+        _settings.update(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                         connect_retries=connect_retries)
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+class GovernedSession(requests.Session):
+    """
+    ``requests.Session`` that admits every request through the governor
+    of its host and reports the outcome back to it.
+    """
+
+    def send(self, request, **kwargs):
+        host_governor = governor.for_url(request.url)
+        host_governor.acquire()
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except RequestException:
+            host_governor.release(time.monotonic() - started, error=True)
+            raise
+        host_governor.release(time.monotonic() - started, response.status_code,
+                              retry_after=response.headers.get("Retry-After"))
+        return response
+
+
+def get_session() -> requests.Session:
+    """
+    Return the process-wide ``requests.Session`` used by all clients.
+
+    Connections are kept alive and pooled per host; ``pool_block`` makes
+    the pool size a hard limit on concurrent connections to one host.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=_settings["pool_connections"],
+                    pool_maxsize=_settings["pool_maxsize"],
+                    max_retries=Retry(total=None, connect=_settings["connect_retries"], read=0,
+                                      status=0, other=0, backoff_factor=0.5),
+                    pool_block=True
+                )
+                session = GovernedSession()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """
+    Return the ``aiohttp.ClientSession`` shared by the async clients on
+    the running event loop, with the same per-host connection limit as
+    the blocking session.
+    """
+    loop = asyncio.get_running_loop()
+    session = getattr(_local, "session", None)
+    if session is None or session.closed or getattr(_local, "loop", None) is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=_settings["pool_connections"] * _settings["pool_maxsize"],
+            limit_per_host=_settings["pool_maxsize"]
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        _local.session = session
+        _local.loop = loop
+    return session
+
+
+async def close_async_session():
+    """
+    Close the async session of this thread; call before the event loop
+    ends.
+    """
+    session = getattr(_local, "session", None)
+    if session is not None and not session.closed:
+        await session.close()
+    _local.session = None
+
+
+async def async_request(method: str, url: str, headers: dict = None, **kwargs):
+    """
+    Send a request through the shared async session and return the
+    decoded JSON body, or the raw text if it is not JSON. The request is
+    admitted by the governor of its host.
+    """
+    host_governor = governor.for_url(url)
+    await host_governor.acquire_async()
+    started = time.monotonic()
+    try:
+        async with get_async_session().request(method, url, headers=headers, **kwargs) as response:
+            status, retry_after = response.status, response.headers.get("Retry-After")
+            response.raise_for_status()
+            text = await response.text()
+    except aiohttp.ClientResponseError:
+        host_governor.release(time.monotonic() - started, status, retry_after=retry_after)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        host_governor.release(time.monotonic() - started, error=True)
+        raise
+    except BaseException:
+        host_governor.release(time.monotonic() - started, adapt=False)
+        raise
+    host_governor.release(time.monotonic() - started, status, retry_after=retry_after)
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
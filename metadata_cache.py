@@ -0,0 +1,136 @@
+### Metadata Cache Implementation ###
+
+import os
+import json
+import time
+import asyncio
+import threading
+from loguru import logger
+from urllib.parse import urlencode
+
+LOG = logger.debug
+
+# Default lifetime of a cache entry, in seconds
+DEFAULT_TTL = 3600
+
+
+def plugin_key(api_base: str, params: dict) -> str:
+    """Cache key of a plugin ID looked up by search parameters."""
+    return f"{api_base}|plugin|{urlencode(sorted(params.items()))}"
+
+
+def pipeline_key(api_base: str, name: str) -> str:
+    """Cache key of the metadata of a pipeline looked up by name."""
+    return f"{api_base}|pipeline|{name}"
+
+
+class MetadataCache:
+    """
+    Key/value cache for CUBE metadata that rarely changes (pipeline IDs,
+    pipings, default parameters...).
+
+    Every entry expires after a TTL and can be invalidated explicitly.
+    When ``path`` is given, entries are loaded from and saved to that JSON
+    file so that later plugin runs start warm. Values must be JSON
+    serializable.
+    """
+
+    def __init__(self, path: str = '', ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+        # in-flight async lookups per event loop, shared by concurrent callers
+        self._pending: dict = {}
+        if path:
+            self.load()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry["expires"] < time.time():
+                self._entries.pop(key, None)
+                return default
+            return entry["value"]
+
+    def set(self, key: str, value, ttl: float = None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = {"value": value, "expires": expires}
+
+    def get_or_fetch(self, key: str, fetch):
+        """
+        Return the cached value of ``key``, calling ``fetch()`` to fill it
+        on a miss.
+        """
+        value = self.get(key)
+        if value is None:
+            value = fetch()
+            self.set(key, value)
+        return value
+
+    async def get_or_fetch_async(self, key: str, fetch):
+        """
+        Async ``get_or_fetch``: ``fetch`` is a coroutine function, and
+        concurrent misses on the same key share a single call.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        pending_key = (id(asyncio.get_running_loop()), key)
+        if pending_key not in self._pending:
+            self._pending[pending_key] = asyncio.ensure_future(self._fetch_async(key, fetch))
+        try:
+            return await asyncio.shield(self._pending[pending_key])
+        finally:
+            self._pending.pop(pending_key, None)
+
+    async def _fetch_async(self, key: str, fetch):
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, prefix: str = ''):
+        """
+        Drop every entry whose key starts with ``prefix``; all of them if
+        no prefix is given.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._entries.pop(key)
+
+    def load(self):
+        """
+        Read unexpired entries from the cache file, if it exists.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as cache_file:
+                entries = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            LOG(f"Ignoring unreadable metadata cache {self.path}: {ex}")
+            return
+        now = time.time()
+        with self._lock:
+            self._entries.update({key: entry for key, entry in entries.items() if entry.get("expires", 0) >= now})
+
+    def save(self):
+        """
+        Write the unexpired entries to the cache file, if one is configured.
+        """
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = {key: entry for key, entry in self._entries.items() if entry["expires"] >= now}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            LOG(f"Could not save metadata cache {self.path}: {ex}")
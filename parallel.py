@@ -0,0 +1,97 @@
+### Parallel Execution Modes ###
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from loguru import logger
+
+LOG = logger.debug
+
+
+# cgroup v2 CPU bandwidth limit, and its cgroup v1 counterparts
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def default_workers() -> int:
+    """
+    Number of CPUs this process may run on: its CPU affinity, capped by
+    the CPU quota of its cgroup (e.g. a container's CPU limit).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def cgroup_cpu_quota():
+    """
+    CPUs granted by the cgroup CPU quota, or ``None`` if unlimited or
+    unknown.
+    """
+    try:
+        with open(CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open(CGROUP_V1_QUOTA) as f:
+                quota = f.read().strip()
+            with open(CGROUP_V1_PERIOD) as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        # "max": no quota
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def threads_per_process(processes: int) -> int:
+    """
+    Threads each of ``processes`` worker processes may use without
+    oversubscribing the CPUs.
+    """
+    return max(1, default_workers() // max(1, processes))
+
+
+def shard_series(records: list[dict], shards: int) -> list[list[dict]]:
+    """
+    Split series records into at most ``shards`` lists of similar size.
+    Series of one study stay in the same shard, so that study-level
+    lookups and retrieves keep covering the whole study.
+    """
+    studies = {}
+    for record in records:
+        studies.setdefault(record.get("StudyInstanceUID"), []).append(record)
+    buckets = [[] for _ in range(max(1, min(shards, len(studies))))]
+    for study in sorted(studies.values(), key=len, reverse=True):
+        min(buckets, key=len).extend(study)
+    return [bucket for bucket in buckets if bucket]
+
+
+def map_threads(worker, shards: list, workers: int) -> list:
+    """
+    Run ``worker`` on every shard in a pool of at most ``workers`` threads.
+    """
+    LOG(f"Processing {len(shards)} shards on {workers} threads.")
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="dy_regiFlow") as pool:
+        return list(pool.map(worker, shards))
+
+
+def map_processes(worker, shards: list, workers: int) -> list:
+    """
+    Run ``worker`` on every shard in a pool of at most ``workers``
+    processes. ``worker`` and its results must be picklable.
+    """
+    LOG(f"Processing {len(shards)} shards on {workers} processes.")
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(worker, shards))
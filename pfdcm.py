@@ -1,9 +1,8 @@
-import requests
 from loguru import logger
 import sys
-import copy
-from collections import ChainMap
-import json
+import asyncio
+
+from http_session import async_request, async_retry_policy
 
 LOG = logger.debug
 
@@ -18,24 +17,11 @@ logger_format = (
 logger.remove()
 logger.add(sys.stderr, format=logger_format)
 
-def health_check(url: str):
-    pfdcm_about_api = f'{url}about/'
-    headers = {'Content-Type': 'application/json', 'accept': 'application/json'}
-    try:
-        response = requests.get(pfdcm_about_api, headers=headers)
-        return response
-    except Exception as er:
-        raise Exception("Connection to pfdcm could not be established.")
-
-
-def retrieve_pacsfiles(directive: dict, url: str, pacs_name: str):
+def retrieve_body(directive: dict, pacs_name: str, then: str = "retrieve") -> dict:
     """
-    This method uses the async API endpoint of `pfdcm` to send a single 'retrieve' request that in
-    turn uses `oxidicom` to push and register PACS files to a CUBE instance
+    Request body of a pfdcm 'retrieve' (or other ``then`` action) for the
+    given directive.
     """
-
-    pfdcm_dicom_api = f'{url}PACS/thread/pypx/'
-    headers = {'Content-Type': 'application/json', 'accept': 'application/json'}
     body = {
         "PACSservice": {
             "value": pacs_name
@@ -45,21 +31,240 @@ def retrieve_pacsfiles(directive: dict, url: str, pacs_name: str):
         },
         "PACSdirective": {
             "withFeedBack": True,
-            "then": "retrieve",
+            "then": then,
             "thenArgs": '',
             "dblogbasepath": '/home/dicom/log',
-            "json_response": False
+            "json_response": then != "retrieve"
         }
     }
     body["PACSdirective"].update(directive)
-    LOG(f"request : {body}")
+    return body
+
+
+def check_retrieve_response(d_response: dict) -> dict:
+    """
+    Return the pfdcm response if its job was accepted, raise otherwise.
+    """
+    if d_response['response']['job']['status']:
+        return d_response
+    else:
+        raise Exception(d_response['message'])
+
+
+def retrieve_progress(d_response, series_instance: str):
+    """
+    Image counts of a series in a pfdcm 'status' response, e.g.
+    ``{"requested": 192, "pushed": 120}``, or ``None`` if the response has
+    no status for the series. ``"failed"`` is set if pfdcm reports an
+    error for it.
+    """
+    entry = _find_series_status(d_response, series_instance)
+    if entry is None:
+        return None
+    progress = {}
+    for stage, counter in entry["images"].items():
+        count = counter.get("count") if isinstance(counter, dict) else counter
+        try:
+            progress[stage] = int(count)
+        except (TypeError, ValueError):
+            continue
+    progress["failed"] = entry.get("status") is False and bool(entry.get("error") or entry.get("message"))
+    return progress
+
+
+def _find_series_status(node, series_instance: str):
+    if isinstance(node, dict):
+        series = node.get("series") if isinstance(node.get("series"), dict) else node
+        uid = series.get("SeriesInstanceUID")
+        if isinstance(uid, dict):
+            uid = uid.get("value")
+        if uid == series_instance and isinstance(node.get("images"), dict):
+            return node
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+    for child in children:
+        found = _find_series_status(child, series_instance)
+        if found is not None:
+            return found
+    return None
+
+
+def retrieve_done(progress: dict) -> bool:
+    """
+    Whether every requested image of a series was received and sent on
+    to CUBE, according to ``retrieve_progress``.
+    """
+    requested = progress.get("requested", 0)
+    received = max(progress.get("pushed", 0), progress.get("registered", 0))
+    return requested > 0 and received >= requested
+
 
-    try:
-        response = requests.post(pfdcm_dicom_api, json=body, headers=headers)
-        d_response = json.loads(response.text)
-        if d_response['response']['job']['status']:
-            return d_response
+# Series fields kept in a study-level retrieve directive
+STUDY_FIELDS = ("StudyInstanceUID", "AccessionNumber", "PatientID", "StudyDate")
+
+
+class AsyncPfdcmClient:
+    """
+    Async pfdcm client for retry retrieves.
+
+    * Retrieves of series of the same study requested within
+      ``batch_window`` seconds are grouped. If the group holds every series
+      of the study this run tracks, one study-level directive replaces the
+      series-level ones.
+    * Every job is followed with ``wait_retrieved`` until pfdcm is done
+      with its series; at most ``max_jobs`` jobs are in progress at a time.
+    * A retrieve requested for a series that already has one in progress
+      waits for that one instead of sending another.
+    """
+
+    def __init__(self, url: str, pacs_name: str, max_jobs: int = 4, batch_window: float = 2.0,
+                 poll_interval: float = 5.0, stall_timeout: float = 60.0):
+        self.url = url
+        self.pacs_name = pacs_name
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.headers = {'Content-Type': 'application/json', 'accept': 'application/json'}
+        self._slots = asyncio.Semaphore(max(1, max_jobs))
+        # SeriesInstanceUID -> future of its pending or running retrieve
+        self._in_flight: dict = {}
+        # StudyInstanceUID -> retrieves waiting to be submitted
+        self._groups: dict = {}
+        self._timers: dict = {}
+        self._jobs: set = set()
+
+    async def retrieve(self, directive: dict, study_series: set = None) -> tuple:
+        """
+        Retrieve one series and follow it until pfdcm is done with it.
+        ``study_series`` are the SeriesInstanceUIDs of its study tracked by
+        the caller, used to decide on a study-level retrieve. Returns the
+        pfdcm response of the job that covered the series and the
+        ``wait_retrieved`` outcome for it.
+        """
+        series_instance = directive["SeriesInstanceUID"]
+        future = self._in_flight.get(series_instance)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[series_instance] = future
+            self._enqueue(directive, study_series or {series_instance}, future)
+        else:
+            LOG(f"Retrieve for {series_instance} already in progress.")
+        return await asyncio.shield(future)
+
+    def _enqueue(self, directive: dict, study_series: set, future: asyncio.Future):
+        study_instance = directive.get("StudyInstanceUID") or directive["SeriesInstanceUID"]
+        group = self._groups.setdefault(study_instance, {"directives": {}, "futures": {}, "expected": set()})
+        group["directives"][directive["SeriesInstanceUID"]] = directive
+        group["futures"][directive["SeriesInstanceUID"]] = future
+        group["expected"] |= set(study_series)
+        if set(group["directives"]) >= group["expected"]:
+            self._flush(study_instance)
+        elif study_instance not in self._timers:
+            self._timers[study_instance] = asyncio.get_running_loop().call_later(
+                self.batch_window, self._flush, study_instance)
+
+    def _flush(self, study_instance: str):
+        timer = self._timers.pop(study_instance, None)
+        if timer is not None:
+            timer.cancel()
+        group = self._groups.pop(study_instance, None)
+        if group is None:
+            return
+        directives = group["directives"]
+        if len(directives) > 1 and set(directives) >= group["expected"]:
+            first = next(iter(directives.values()))
+            study_directive = {field: first[field] for field in STUDY_FIELDS if first.get(field)}
+            LOG(f"Retrieving study {study_instance} once for {len(directives)} series.")
+            jobs = [(study_directive, directives)]
+        else:
+            jobs = [(directive, {series_instance: directive}) for series_instance, directive in directives.items()]
+        for directive, series_directives in jobs:
+            job = asyncio.ensure_future(self._run_job(directive, series_directives, group["futures"]))
+            self._jobs.add(job)
+            job.add_done_callback(self._jobs.discard)
+
+    async def _run_job(self, directive: dict, series_directives: dict, futures: dict):
+        # the job keeps its slot, and its series stay in flight, until pfdcm is done with them
+        async with self._slots:
+            try:
+                d_response = await self._post(directive)
+            except Exception as ex:
+                LOG(f"Retrieve of {list(series_directives)} failed: {ex}")
+                for series_instance in series_directives:
+                    self._settle(series_instance, futures[series_instance], ex)
+                return
+            await asyncio.gather(*(
+                self._follow(series_directive, d_response, futures[series_instance])
+                for series_instance, series_directive in series_directives.items()))
+
+    async def _follow(self, directive: dict, d_response: dict, future: asyncio.Future):
+        try:
+            outcome = (d_response, await self.wait_retrieved(directive, self.poll_interval, self.stall_timeout))
+        except Exception as ex:
+            outcome = ex
+        self._settle(directive["SeriesInstanceUID"], future, outcome)
+
+    def _settle(self, series_instance: str, future: asyncio.Future, outcome):
+        self._in_flight.pop(series_instance, None)
+        if future.done():
+            return
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
         else:
-            raise Exception(d_response['message'])
-    except Exception as er:
-        LOG(er)
\ No newline at end of file
+            future.set_result(outcome)
+
+    @async_retry_policy(attempts=3)
+    async def _post(self, directive: dict) -> dict:
+        body = retrieve_body(directive, self.pacs_name)
+        LOG(f"request : {body}")
+        d_response = await async_request("POST", f'{self.url}PACS/thread/pypx/', json=body, headers=self.headers)
+        return check_retrieve_response(d_response)
+
+    async def status(self, directive: dict):
+        """
+        Retrieve progress of a series as reported by pfdcm, see
+        ``retrieve_progress``; ``None`` if pfdcm could not tell.
+        """
+        body = retrieve_body(directive, self.pacs_name, then="status")
+        d_response = await async_request("POST", f'{self.url}PACS/sync/pypx/', json=body, headers=self.headers)
+        if isinstance(d_response, dict) and d_response.get("status") is False:
+            LOG(f"pfdcm status request failed: {d_response.get('message', '')}")
+            return None
+        return retrieve_progress(d_response, directive["SeriesInstanceUID"])
+
+    async def wait_retrieved(self, directive: dict, interval: float, stall_timeout: float):
+        """
+        Poll pfdcm until the retrieve of a series has completed.
+
+        Returns ``True`` once every requested image was pushed, and
+        ``None`` if pfdcm does not report the series or its counts stop
+        moving for ``stall_timeout`` seconds, so the caller should look at
+        CUBE itself. Raises ``RuntimeError`` if the retrieve failed.
+        """
+        series_instance = directive["SeriesInstanceUID"]
+        loop = asyncio.get_running_loop()
+        last_change = loop.time()
+        last_progress = None
+        while True:
+            try:
+                progress = await self.status(directive)
+            except Exception as ex:
+                LOG(f"Retrieve status of {series_instance} unavailable: {ex}")
+                return None
+            if progress is None:
+                return None
+            if progress["failed"]:
+                raise RuntimeError(f"pfdcm reported a failed retrieve for {series_instance}")
+            if retrieve_done(progress):
+                LOG(f"Retrieve of {series_instance} complete: {progress}.")
+                return True
+            if progress != last_progress:
+                last_progress = progress
+                last_change = loop.time()
+            elif loop.time() - last_change >= stall_timeout:
+                LOG(f"Retrieve of {series_instance} stalled at {progress}.")
+                return None
+            await asyncio.sleep(interval)
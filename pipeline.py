@@ -1,21 +1,24 @@
 import json
-import requests
-from requests.auth import HTTPBasicAuth
-from requests.exceptions import RequestException, Timeout, HTTPError
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 from loguru import logger
-import time
 import asyncio
 from urllib.parse import urlencode
 import pandas as pd
 
-def transform_plugin_data(nested_data_list: list[dict]) -> list[dict]:
-    """Flatten nested plugin data into a list of dictionaries."""
-    flat_data = []
-    for item in nested_data_list:
-        entry = {pair['name']: pair['value'] for pair in item.get("data", [])}
-        flat_data.append(entry)
-    return flat_data
+from http_session import async_request, async_retry_policy
+from metadata_cache import MetadataCache, plugin_key, pipeline_key
+from collection_json import items, records, item_record, first_value
+
+# Fields of a pipeline default parameter used to build a workflow
+PARAMETER_FIELDS = ("plugin_piping_id", "previous_plugin_piping_id", "plugin_piping_title", "param_name", "value")
+# Job counters of a workflow, by job status
+JOB_FIELDS = ("finished_jobs", "errored_jobs", "cancelled_jobs", "created_jobs", "waiting_jobs",
+              "scheduled_jobs", "started_jobs", "registering_jobs")
+WORKFLOW_FIELDS = frozenset(("id", "creation_date") + JOB_FIELDS)
+FEED_FIELDS = ("creation_date", "name", "owner_username")
+
+def transform_plugin_data(nested_data_list: list[dict], fields=None) -> list[dict]:
+    """Flatten nested plugin data into a list of dictionaries, keeping only ``fields`` if given."""
+    return records(nested_data_list, fields)
 
 
 def update_plugin_parameters(d_piping: list[dict], plugin_params: dict) -> list[dict]:
@@ -63,176 +66,274 @@ def compute_workflow_nodes_info(pipeline_default_parameters: list[dict], include
     return nodes_info
 
 
-class Pipeline:
-    def __init__(self, url: str, token: str):
+class WorkflowTemplate:
+    """
+    ``nodes_info`` of a pipeline compiled once from its metadata.
+
+    Pipings are indexed by title and their parameters by name, so that
+    rendering the workflow of a series only copies and patches the pipings
+    whose parameters change; all other pipings are shared with the
+    template.
+    """
+
+    __slots__ = ("metadata", "pipeline_id", "total_jobs", "nodes_info", "_titles", "_params", "_matches")
+
+    def __init__(self, metadata: dict):
+        self.metadata = metadata
+        self.pipeline_id = metadata["id"]
+        self.total_jobs = metadata["total_jobs"]
+        self.nodes_info = compute_workflow_nodes_info(metadata["parameters"], include_all_defaults=True)
+        self._titles: dict = {}
+        self._params: dict = {}
+        self._matches: dict = {}
+        for index, piping in enumerate(self.nodes_info):
+            self._titles.setdefault(piping.get('title', ''), []).append(index)
+            for param_index, param in enumerate(piping.get('plugin_parameter_defaults', [])):
+                self._params[(index, param['name'])] = param_index
+
+    def _match(self, plugin_title: str) -> list[int]:
+        """
+        Indexes of the pipings whose title contains ``plugin_title``.
+        """
+        if plugin_title not in self._matches:
+            self._matches[plugin_title] = [
+                index for title, indexes in self._titles.items() if plugin_title in title for index in indexes
+            ]
+        return self._matches[plugin_title]
+
+    def render(self, plugin_params: dict) -> list[dict]:
+        """
+        Override default parameters in the pipeline with user-provided values.
+        """
+        nodes_info = list(self.nodes_info)
+        for plugin_title, new_params in plugin_params.items():
+            for index in self._match(plugin_title):
+                piping = nodes_info[index]
+                for name, value in new_params.items():
+                    param_index = self._params.get((index, name))
+                    if param_index is None:
+                        continue
+                    if piping is self.nodes_info[index]:
+                        piping = dict(piping)
+                        piping['plugin_parameter_defaults'] = list(piping['plugin_parameter_defaults'])
+                        nodes_info[index] = piping
+                    piping['plugin_parameter_defaults'][param_index] = {'name': name, 'default': value}
+        return nodes_info
+
+    def to_json(self, plugin_params: dict) -> str:
+        """Serialize the rendered workflow as the ``nodes_info`` of ``post_workflow``."""
+        return json.dumps(self.render(plugin_params))
+
+
+NOTIFICATION_PLUGIN = {"name": "pl-notification", "version": "0.1.0"}
+
+
+def get_workflow_status_from_items(items: list[dict]) -> dict:
+    """
+    1. Check for errored jobs
+    2. return total jobs (finished + errored + canceled)
+    """
+    jobs = {}
+    for record in records(items, WORKFLOW_FIELDS):
+        jobs.update(record)
+    return workflow_status(jobs)
+
+
+def workflow_status(jobs: dict) -> dict:
+    """Workflow status from its job counters; missing counters count as 0."""
+    counts = {name: jobs.get(name, 0) for name in JOB_FIELDS}
+    return {
+        "creation_date": jobs.get("creation_date"),
+        "finished_jobs": counts["finished_jobs"],
+        "scheduled_jobs": counts["scheduled_jobs"],
+        "started_jobs": counts["started_jobs"],
+        "total_jobs": sum(counts.values()),
+        "workflow_failed": (counts["errored_jobs"] > 0 or counts["cancelled_jobs"] > 0)
+    }
+
+
+def workflow_outcome(status: dict, total_jobs: int):
+    """
+    Final outcome of a workflow given its status, or ``None`` while it is
+    still running. Without ``total_jobs``, the jobs in the status count.
+    """
+    if total_jobs is None:
+        total_jobs = max(status["total_jobs"], 1)
+    if status["workflow_failed"]:
+        return "pipeline failed"
+    if status["finished_jobs"] >= total_jobs:
+        return "complete"
+    if status["total_jobs"] < total_jobs:
+        return "nodes deleted from the workflow"
+    return None
+
+
+def compose_notification(feed_details: dict, series_data: str) -> str:
+    """Email body reporting a failed anonymization pipeline."""
+    d_series = json.loads(series_data)
+    return (f"An error occurred while running anonymization pipeline on the following data: "
+            f"\nFeed Name: {feed_details['name']}"
+            f"\nDate: {feed_details['date']}"
+            f"\nMRN: {d_series['PatientID']} "
+            f"\nStudyDate: {d_series['StudyDate']}"
+            f"\nModality: {d_series['Modality']}"
+            f"\nSeriesDescription: {d_series['SeriesDescription']}"
+            f"\nFolder Name: {d_series['Folder Name']}"
+            f"\n\nKindly login to ChRIS as *{feed_details['owner']}* to access the logs for more details.")
+
+
+class AsyncPipeline:
+    """
+    Client of the CUBE pipeline and workflow APIs on the shared aiohttp
+    session.
+    """
+
+    def __init__(self, url: str, token: str, cache: MetadataCache = None):
         self.api_base = url.rstrip('/')
         self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
+        self.cache = cache if cache is not None else MetadataCache()
+        self._templates: dict = {}
+        # WorkflowMonitor tracking the workflows posted by run_pipeline, set before running any
+        self.monitor = None
 
     # --------------------------
     # Retryable request handler
     # --------------------------
-    @retry(
-        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        stop=stop_after_attempt(5),
-        reraise=True
-    )
-    def make_request(self, method: str, endpoint: str, **kwargs):
-        url = f"{self.api_base}{endpoint}"
-        response = requests.request(method, url, headers=self.headers, timeout=30, **kwargs)
-        response.raise_for_status()
+    async def _send(self, method: str, endpoint: str, **kwargs):
+        response = await async_request(method, f"{self.api_base}{endpoint}", headers=self.headers, **kwargs)
+        if isinstance(response, dict):
+            return items(response)
+        return response
 
-        try:
-            return response.json().get("collection", {}).get("items", [])
-        except ValueError:
-            return response.text
-
-    @retry(
-        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        stop=stop_after_attempt(2),
-        reraise=True
-    )
-    def post_request(self, endpoint: str, **kwargs):
-        url = f"{self.api_base}{endpoint}"
-        response = requests.request("POST", url, headers=self.headers, timeout=30, **kwargs)
-        response.raise_for_status()
+    @async_retry_policy()
+    async def make_request(self, method: str, endpoint: str, **kwargs):
+        return await self._send(method, endpoint, **kwargs)
 
-        try:
-            return response.json().get("collection", {}).get("items", [])
-        except ValueError:
-            return response.text
+    @async_retry_policy(attempts=2)
+    async def post_request(self, endpoint: str, **kwargs):
+        return await self._send("POST", endpoint, **kwargs)
 
     # --------------------------
     # Pipeline helpers
     # --------------------------
-    def get_pipeline_id(self, name: str) -> int:
+    async def get_pipeline_id(self, name: str) -> int:
         """Fetch pipeline ID by name."""
         logger.info(f"Fetching ID for pipeline: {name}")
-        response = self.make_request("GET", f"/pipelines/search/?name={name}")
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
-        return -1
+        response = await self.make_request("GET", f"/pipelines/search/?name={name}")
+        return first_value(response, "id", -1)
 
-    def get_pipeline_total_pipings(self, pipeline_id: int) -> int:
+    async def get_pipeline_total_pipings(self, pipeline_id: int) -> int:
         """Get the total number of plugin pipings in the given pipeline."""
         logger.info(f"Fetching pipeline plugin piping list.")
-        response = self.make_request("GET", f"/pipelines/{pipeline_id}/pipings/?limit=100")
+        response = await self.make_request("GET", f"/pipelines/{pipeline_id}/pipings/?limit=100")
         return len(response)
 
-
-    def get_pipeline_parameters(self, pipeline_id: int) -> list[dict]:
+    async def get_pipeline_parameters(self, pipeline_id: int) -> list[dict]:
         """Get default parameters for a pipeline."""
         logger.info(f"Fetching default parameters for pipeline with ID: {pipeline_id}")
-        response = self.make_request("GET", f"/pipelines/{pipeline_id}/parameters/?limit=1000")
-        return transform_plugin_data(response)
+        response = await self.make_request("GET", f"/pipelines/{pipeline_id}/parameters/?limit=1000")
+        return transform_plugin_data(response, PARAMETER_FIELDS)
+
+    async def get_pipeline_metadata(self, name: str) -> dict:
+        """
+        Get ID, total pipings and default parameters of a pipeline,
+        served from the metadata cache when possible. Concurrent callers
+        share a single lookup.
+        """
+        return await self.cache.get_or_fetch_async(pipeline_key(self.api_base, name),
+                                                   lambda: self._fetch_pipeline_metadata(name))
 
-    def get_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
+    async def get_workflow_template(self, name: str) -> WorkflowTemplate:
+        """
+        Get the compiled workflow template of a pipeline.
+        """
+        return self._compile_template(name, await self.get_pipeline_metadata(name))
+
+    async def _fetch_pipeline_metadata(self, name: str) -> dict:
+        pipeline_id = await self.get_pipeline_id(name)
+        if pipeline_id == -1:
+            raise RuntimeError(f"No pipeline found with name: {name}")
+        total_jobs, parameters = await asyncio.gather(
+            self.get_pipeline_total_pipings(pipeline_id),
+            self.get_pipeline_parameters(pipeline_id)
+        )
+        return {"id": pipeline_id, "total_jobs": total_jobs, "parameters": parameters}
+
+    def _compile_template(self, name: str, metadata: dict) -> WorkflowTemplate:
+        template = self._templates.get(name)
+        if template is None or template.metadata is not metadata:
+            template = WorkflowTemplate(metadata)
+            self._templates[name] = template
+        return template
+
+    def invalidate_pipeline_metadata(self, name: str):
+        """Drop the cached metadata and template of a pipeline."""
+        self.cache.invalidate(pipeline_key(self.api_base, name))
+        self._templates.pop(name, None)
+
+    async def get_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
         """Get feed_id from a given plugin instance"""
         logger.info(f"Fetching feed id for plugin instance with ID: {plugin_inst}")
-        response = self.make_request("GET", f"/plugins/instances/{plugin_inst}/")
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "feed_id":
-                    return field.get("value")
-        return -1
+        response = await self.make_request("GET", f"/plugins/instances/{plugin_inst}/")
+        return first_value(response, "feed_id", -1)
 
-    def get_feed_details_from_id(self, feed_id: int) -> dict:
+    async def get_feed_details_from_id(self, feed_id: int) -> dict:
         """Get feed details given a feed id"""
-        feed_details = {}
-
         logger.info(f"Getting feed details for ID: {feed_id}")
-        response = self.make_request("GET", f"/{feed_id}/")
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "creation_date":
-                    feed_details["date"] = field.get("value")
-                if field.get("name") == "name":
-                    feed_details["name"] = field.get("value")
-                if field.get("name") == "owner_username":
-                    feed_details["owner"] = field.get("value")
+        response = await self.make_request("GET", f"/{feed_id}/")
+        return self._feed_details(response)
+
+    @staticmethod
+    def _feed_details(response: list[dict]) -> dict:
+        feed_details = {}
+        for record in records(response, FEED_FIELDS):
+            if "creation_date" in record:
+                feed_details["date"] = record.creation_date
+            if "name" in record:
+                feed_details["name"] = record.name
+            if "owner_username" in record:
+                feed_details["owner"] = record.owner_username
 
         return feed_details
 
-    def post_workflow(self, pipeline_id: int, previous_id: int, params: list[dict]) -> int:
+    async def post_workflow(self, pipeline_id: int, previous_id: int, params) -> int:
         """
         Trigger a pipeline workflow in CUBE.
         """
         payload = {
             "previous_plugin_inst_id": previous_id,
-            "nodes_info": json.dumps(params)
+            "nodes_info": params if isinstance(params, str) else json.dumps(params)
         }
-        response = self.post_request(f"/pipelines/{pipeline_id}/workflows/", json=payload)
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
-        return -1
+        response = await self.post_request(f"/pipelines/{pipeline_id}/workflows/", json=payload)
+        return first_value(response, "id", -1)
 
     async def get_workflow_status(self, workflow_id: int) -> dict:
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, self._get_workflow_status, workflow_id)
+        logger.info(f"Fetching workflow details for ID: {workflow_id}")
+        response = await self.make_request("GET", f"/pipelines/workflows/{workflow_id}/")
+        return get_workflow_status_from_items(response)
 
-    def _get_workflow_status(self, workflow_id: int) -> dict:
+    async def list_workflows(self, params: dict, page_size: int = 100) -> dict:
         """
-        1. Get workflow details for a given workflow id.
-        2. Check for errored jobs
-        3. return total jobs (finished + errored + canceled)
+        Status of every workflow matching the search ``params``, keyed by
+        workflow ID, fetched with paged list queries.
         """
-        finished_jobs = 0
-        errored_jobs = 0
-        cancelled_jobs = 0
-        created_jobs = 0
-        waiting_jobs = 0
-        scheduled_jobs = 0
-        started_jobs = 0
-        registering_jobs = 0
-
-        logger.info(f"Fetching workflow details for ID: {workflow_id}")
-        response = self.make_request("GET", f"/pipelines/workflows/{workflow_id}/")
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "finished_jobs":
-                    finished_jobs = field.get("value")
-                if field.get("name") == "errored_jobs":
-                    errored_jobs = field.get("value")
-                if field.get("name") == "cancelled_jobs":
-                    cancelled_jobs = field.get("value")
-                if field.get("name") == "created_jobs":
-                    created_jobs = field.get("value")
-                if field.get("name") == "waiting_jobs":
-                    waiting_jobs = field.get("value")
-                if field.get("name") == "scheduled_jobs":
-                    scheduled_jobs = field.get("value")
-                if field.get("name") == "started_jobs":
-                    started_jobs = field.get("value")
-                if field.get("name") == "registering_jobs":
-                    registering_jobs = field.get("value")
-
-
-        return {
-            "finished_jobs": finished_jobs,
-            "total_jobs": finished_jobs + errored_jobs + cancelled_jobs + created_jobs + waiting_jobs + scheduled_jobs + started_jobs + registering_jobs,
-            "workflow_failed": (errored_jobs > 0 or cancelled_jobs > 0)
-        }
-
-    async def monitor_pipeline(self, workflow_id, total_jobs, pv_inst, rcpts, smtp, series_data):
+        statuses = {}
+        offset = 0
         while True:
-            status = self._get_workflow_status(workflow_id)
-            if status["workflow_failed"]:
-                logger.error("Pipeline failed.")
-                # self.run_notification_plugin(pv_inst, "Pipeline failed with errors", rcpts, smtp, series_data)
-                break
-            if status["finished_jobs"] >= total_jobs:
-                logger.info("Pipeline complete.")
-                break
-            if status["total_jobs"] < total_jobs:
-                logger.info("Nodes deleted from the workflow")
-                # self.run_notification_plugin(pv_inst, "Nodes deleted in pipeline", rcpts, smtp, series_data)
-                break
-            time.sleep(20)
+            query_string = urlencode({**params, "limit": page_size, "offset": offset})
+            response = await self.make_request("GET", f"/pipelines/workflows/search/?{query_string}")
+            self._collect_statuses(response, statuses)
+            if len(response) < page_size:
+                return statuses
+            offset += page_size
+
+    @staticmethod
+    def _collect_statuses(response: list[dict], statuses: dict):
+        for item in response:
+            record = item_record(item, WORKFLOW_FIELDS)
+            workflow_id = record.get("id")
+            if workflow_id is not None:
+                statuses[workflow_id] = workflow_status(record)
 
     def write_to_error_logs(self):
         """
@@ -241,26 +342,17 @@ class Pipeline:
         """
         pass
 
-    def run_notification_plugin(self, pv_id: int, msg: str, rcpts: str, smtp: str, series_data: str) -> int:
+    async def run_notification_plugin(self, pv_id: int, msg: str, rcpts: str, smtp: str, series_data: str) -> int:
         """
         Run the pl-notification plugin.
         """
-        feed_id = self.get_feed_id_from_plugin_inst(pv_id)
-        feed_details = self.get_feed_details_from_id(feed_id)
-        d_series = json.loads(series_data)
-        email_content = (f"An error occurred while running anonymization pipeline on the following data: "
-                         f"\nFeed Name: {feed_details['name']}"
-                         f"\nDate: {feed_details['date']}"
-                         f"\nMRN: {d_series['PatientID']} "
-                         f"\nStudyDate: {d_series['StudyDate']}"
-                         f"\nModality: {d_series['Modality']}"
-                         f"\nSeriesDescription: {d_series['SeriesDescription']}"
-                         f"\nFolder Name: {d_series['Folder Name']}"
-                         f"\n\nKindly login to ChRIS as *{feed_details['owner']}* to access the logs for more details.")
+        feed_id = await self.get_feed_id_from_plugin_inst(pv_id)
+        feed_details = await self.get_feed_details_from_id(feed_id)
+        email_content = compose_notification(feed_details, series_data)
 
         try:
-            plugin_id = self._get_plugin_id({"name": "pl-notification", "version": "0.1.0"})
-            instance_id = self._create_plugin_instance(plugin_id, {
+            plugin_id = await self._get_plugin_id(NOTIFICATION_PLUGIN)
+            instance_id = await self._create_plugin_instance(plugin_id, {
                 "previous_id": pv_id,
                 "content": email_content,
                 "title": msg,
@@ -272,57 +364,46 @@ class Pipeline:
         except Exception as ex:
             logger.error(f"Error occurred while creating notification instance {ex}")
 
-    def _create_plugin_instance(self, plugin_id: str, params: dict):
-        """
-        Create a plugin instance and return its ID.
-        """
-        response = self.post_request( f"/plugins/{plugin_id}/instances/", json=params)
-
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
+    async def _create_plugin_instance(self, plugin_id: str, params: dict):
+        response = await self.post_request(f"/plugins/{plugin_id}/instances/", json=params)
+        instance_id = first_value(response, "id")
+        if instance_id is None:
+            raise RuntimeError("Plugin instance could not be scheduled.")
+        return instance_id
 
-        raise RuntimeError("Plugin instance could not be scheduled.")
+    async def _get_plugin_id(self, params: dict):
+        return await self.cache.get_or_fetch_async(plugin_key(self.api_base, params),
+                                                   lambda: self._search_plugin_id(params))
 
-    def _get_plugin_id(self, params: dict):
-        """
-        Fetch plugin ID by search parameters.
-        """
+    async def _search_plugin_id(self, params: dict):
         query_string = urlencode(params)
-        response = self.make_request("GET", f"/plugins/search/?{query_string}")
-
-        for item in response:
-            for field in item.get("data", []):
-                if field.get("name") == "id":
-                    return field.get("value")
-
-        raise RuntimeError(f"No plugin found with matching criteria: {params}")
-
+        response = await self.make_request("GET", f"/plugins/search/?{query_string}")
+        plugin_id = first_value(response, "id")
+        if plugin_id is None:
+            raise RuntimeError(f"No plugin found with matching criteria: {params}")
+        return plugin_id
 
     async def run_pipeline(self, pipeline_name: str, previous_inst: int, pipeline_params: dict, recipients: str, smtp_server: str, series_data: str):
         """
         Full workflow to:
-        1. Fetch pipeline ID
-        2. Get default parameters
-        3. Update them
-        4. Trigger the pipeline
+        1. Fetch the compiled workflow template (cached)
+        2. Patch it with the series parameters
+        3. Trigger the pipeline
         """
+        if self.monitor is None:
+            raise RuntimeError("A WorkflowMonitor must track the workflows posted by run_pipeline.")
         try:
-            pipeline_id = self.get_pipeline_id(pipeline_name)
-            total_jobs = self.get_pipeline_total_pipings(pipeline_id)
-            default_params = self.get_pipeline_parameters(pipeline_id)
-            nodes_info = compute_workflow_nodes_info(default_params, include_all_defaults=True)
-            updated_params = update_plugin_parameters(nodes_info, pipeline_params)
-            workflow_id = self.post_workflow(pipeline_id=pipeline_id, previous_id=previous_inst, params=updated_params)
-            #self.run_notification_plugin(previous_inst)
+            template = await self.get_workflow_template(pipeline_name)
+            total_jobs = template.total_jobs
+            workflow_id = await self.post_workflow(pipeline_id=template.pipeline_id, previous_id=previous_inst,
+                                                   params=template.to_json(pipeline_params))
 
-            # Start this in the background (not awaited)
-            asyncio.create_task(self.monitor_pipeline(workflow_id, total_jobs, previous_inst, recipients, smtp_server, series_data))
+            self.monitor.register(workflow_id, total_jobs, series_data)
 
             logger.info(f"Workflow posted successfully")
-            return {"status": "Pipeline running"}
+            return {"status": "Pipeline running", "workflow_id": workflow_id, "total_jobs": total_jobs}
 
         except Exception as ex:
             logger.error(f"Running pipeline failed due to: {ex}")
+            self.invalidate_pipeline_metadata(pipeline_name)
             return {"status": "Failed", "error": str(ex)}
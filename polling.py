@@ -0,0 +1,67 @@
+### Adaptive Registration Polling ###
+
+import random
+from loguru import logger
+
+from series_table import SeriesState
+
+LOG = logger.debug
+
+
+class AdaptivePoller:
+    """
+    Decide when to poll a series next, from the progress of its file
+    registration.
+
+    * While the registered-file count does not change, the delay grows
+      exponentially from ``base_interval`` up to ``max_interval``, with
+      random jitter so that series do not poll in lockstep.
+    * While files keep arriving, the next poll is aimed at the estimated
+      completion time, so series close to their expected total are polled
+      sooner.
+    * Once no progress was seen for ``stall_timeout`` seconds, the series
+      is given up on (``next_delay`` returns ``None``).
+    """
+
+    def __init__(self, base_interval: float, stall_timeout: float, max_interval: float = None,
+                 backoff: float = 1.5, jitter: float = 0.2):
+        self.base_interval = max(base_interval, 0.1)
+        self.max_interval = max_interval if max_interval is not None else 6 * self.base_interval
+        self.stall_timeout = stall_timeout
+        self.backoff = backoff
+        self.jitter = jitter
+
+    def reset(self, series: SeriesState, now: float):
+        """
+        Start tracking progress of a series from scratch, e.g. after a
+        retrieve retry.
+        """
+        series.poll_count = 0
+        series.stalled_polls = 0
+        series.last_progress = now
+
+    def next_delay(self, series: SeriesState, registered_files: int, now: float):
+        """
+        Record the latest registered-file count seen for a series and
+        return the delay before its next poll, or ``None`` to give up.
+        """
+        expected = max(int(series.NumberOfSeriesRelatedInstances or 0), 1)
+        if registered_files > series.registered_files:
+            rate = (registered_files - series.registered_files) / max(now - series.last_progress, 1e-3)
+            series.registered_files = registered_files
+            series.last_progress = now
+            series.stalled_polls = 0
+            remaining = max(expected - registered_files, 0)
+            return self._jittered(min(max(remaining / rate, self.base_interval / 2), self.max_interval))
+
+        if now - series.last_progress >= self.stall_timeout:
+            LOG(f"No registration progress for {series.SeriesInstanceUID} in {self.stall_timeout}s "
+                f"({series.registered_files}/{expected} files).")
+            return None
+
+        series.stalled_polls += 1
+        delay = min(self.base_interval * self.backoff ** (series.stalled_polls - 1), self.max_interval)
+        return self._jittered(min(delay, max(self.stall_timeout - (now - series.last_progress), 0.0)))
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
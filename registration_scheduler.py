@@ -0,0 +1,470 @@
+### Registration Scheduler Implementation ###
+
+import json
+import heapq
+import asyncio
+from contextlib import nullcontext
+from argparse import Namespace
+from loguru import logger
+
+import pfdcm
+from chris_pacs_service import AsyncPACSClient, AsyncSeriesWatcher
+from chrisClient import AsyncChrisClient
+from series_table import SeriesState
+from polling import AdaptivePoller
+from registration_stats import RegistrationStats
+from run_journal import RunJournal
+from workflow_monitor import WorkflowMonitor
+
+LOG = logger.debug
+
+# Fraction of the predicted registration time to wait before the first poll
+FIRST_POLL_FACTOR = 0.8
+
+
+class RegistrationScheduler:
+    """
+    Iterative deadline scheduler for series registration.
+
+    Series are kept in a priority queue ordered by their next poll time.
+    Every due series gets a single poll step; the step updates the series
+    state in place and either finishes the series or pushes it back onto
+    the queue with a new deadline. At most ``max_concurrency`` steps run
+    at once.
+
+    Registration is looked up per study: steps of series that share a
+    StudyInstanceUID share one study-level search per poll interval. In
+    watch mode (``options.watch``) only the first poll of a series is such
+    a lookup; later polls share one incremental ``AsyncSeriesWatcher`` sweep.
+
+    Poll timing comes from an ``AdaptivePoller`` fed with the number of
+    files of the series registered so far: polls back off while nothing
+    arrives, follow the arrival rate while files come in, and a series
+    that makes no progress for ``maxPoll`` poll intervals is retried, even
+    while other series of its study keep registering.
+
+    The first poll of a series waits for most of the registration time
+    predicted by ``RegistrationStats`` from past runs, and the observed
+    latency of every registered series is recorded back into the stats.
+
+    A series that needs a retry leaves the queue while pfdcm retrieves it
+    again, and comes back once pfdcm reports the retrieve complete. A
+    failed retrieve sends the series back to polling as well, so the next
+    retry only comes after another ``maxPoll`` intervals without progress.
+
+    State changes of every series are appended to a ``RunJournal``. A
+    series the journal shows with a completed pipeline is skipped, one
+    with a pipeline still running is handed to the ``WorkflowMonitor``,
+    and one it shows registered goes straight to anonymization.
+
+    A registered series leaves the queue for the submission stage, where
+    at most ``max_concurrency`` submissions run at once. With a
+    ``WorkflowMonitor`` given, submissions also wait for room under its
+    in-flight job ceiling, without holding up the polling of other series.
+    With ``options.batchStudies``, the registered series of a study are
+    submitted together, with one dsdircopy instance and one workflow.
+    """
+
+    def __init__(self, options: Namespace, client: AsyncPACSClient, cube_con: AsyncChrisClient,
+                 stats: RegistrationStats = None, journal: RunJournal = None, monitor: WorkflowMonitor = None):
+        self.options = options
+        self.client = client
+        self.cube_con = cube_con
+        self.max_concurrency = max(1, options.maxConcurrency)
+        self.contains_errors = False
+        self._series: dict = {}
+        self._queue: list = []
+        self._counter = 0
+        self.watcher = AsyncSeriesWatcher(client) if options.watch else None
+        self._studies: dict = {}
+        self._shared_calls: dict = {}
+        self._retrieves: set = set()
+        self._added = asyncio.Event()
+        # every series of a study given to the scheduler, finished ones included
+        self._study_members: dict = {}
+        self.stats = stats if stats is not None else RegistrationStats()
+        self.journal = journal
+        self.monitor = monitor
+        self._submissions: set = set()
+        self._submit_slots = asyncio.Semaphore(self.max_concurrency)
+        self._batches: dict = {}
+        self.poller = AdaptivePoller(options.pollInterval, options.maxPoll * options.pollInterval)
+        # retries of one study are spread by poll jitter; give them a few intervals to group
+        self.pfdcm = pfdcm.AsyncPfdcmClient(options.PACSurl, options.PACSname, options.pfdcmJobs,
+                                            3 * options.pollInterval, options.pollInterval,
+                                            self.poller.stall_timeout)
+
+    def add(self, series: SeriesState, delay: float = 0):
+        """
+        Register a series with the scheduler and schedule its first poll.
+        """
+        series_instance = series.SeriesInstanceUID
+        self._study_members.setdefault(series.StudyInstanceUID, set()).add(series_instance)
+        if self.journal is not None and self.journal.is_done(series_instance):
+            entry = self.journal.entry(series_instance)
+            series.status, series.workflow_id = entry["status"], entry.get("workflow_id")
+            LOG(f"Series {series_instance} already finished in an earlier run: {series.status}.")
+            return
+        if self.journal is not None and self.journal.is_running(series_instance) and self.monitor is not None:
+            entry = self.journal.entry(series_instance)
+            series.status, series.workflow_id = entry["status"], entry["workflow_id"]
+            LOG(f"Series {series_instance} has workflow {series.workflow_id} running since an earlier run.")
+            self.monitor.register(series.workflow_id, entry.get("total_jobs"), series.to_json())
+            return
+        if self._resume(series):
+            delay = 0
+        else:
+            self._record(series_instance, "queued", retry=series.retry)
+        delay = max(delay, self._first_poll_delay(series)) if series.status != "registered" else delay
+        series.queued_at = asyncio.get_running_loop().time()
+        self.poller.reset(series, series.queued_at + delay)
+        self._series[series_instance] = series
+        self._studies.setdefault(series.StudyInstanceUID, set()).add(series_instance)
+        self._schedule(series_instance, delay)
+        self._added.set()
+
+    def _resume(self, series: SeriesState) -> bool:
+        """
+        Restore the journaled state of a series. Returns ``True`` if the
+        series was journaled before.
+        """
+        if self.journal is None:
+            return False
+        entry = self.journal.entry(series.SeriesInstanceUID)
+        if not entry:
+            return False
+        if entry.get("status") not in ("registration failed", "pipeline not started"):
+            series.retry = entry.get("retry", series.retry)
+        if entry.get("registered"):
+            series.status = "registered"
+        return True
+
+    def _record(self, series_instance: str, event: str, **data):
+        if self.journal is not None:
+            self.journal.record(series_instance, event, **data)
+
+    def _first_poll_delay(self, series: SeriesState) -> float:
+        predicted = self.stats.predict(series.Modality, series.NumberOfSeriesRelatedInstances)
+        if predicted is None:
+            return 0.0
+        LOG(f"Series {series.SeriesInstanceUID} predicted to register in {predicted:.1f}s.")
+        return predicted * FIRST_POLL_FACTOR
+
+    def _remove(self, series_instance: str):
+        series = self._series.pop(series_instance, None)
+        if series is None:
+            return
+        study = self._studies.get(series.StudyInstanceUID, set())
+        study.discard(series_instance)
+        if not study:
+            self._studies.pop(series.StudyInstanceUID, None)
+
+    def _schedule(self, series_instance: str, delay: float):
+        loop = asyncio.get_running_loop()
+        self._counter += 1
+        heapq.heappush(self._queue, (loop.time() + delay, self._counter, series_instance))
+
+    async def run(self, source=None) -> bool:
+        """
+        Drive the queue until every series is finished. Series read from
+        the async iterable ``source`` are added while the queue runs.
+        Returns ``True`` if any series errored.
+        """
+        loop = asyncio.get_running_loop()
+        tasks: set = set()
+        if self.watcher:
+            try:
+                await self.watcher.prime()
+            except Exception as ex:
+                LOG(f"Priming the series watcher failed, polling by study instead: {ex}")
+                self.watcher = None
+        ingest = asyncio.ensure_future(self._ingest(source)) if source is not None else None
+        while self._queue or tasks or self._retrieves or self._submissions or (ingest and not ingest.done()):
+            while self._queue and self._queue[0][0] <= loop.time() and len(tasks) < self.max_concurrency:
+                _, _, series_instance = heapq.heappop(self._queue)
+                tasks.add(asyncio.create_task(self._step(series_instance)))
+
+            timeout = None
+            if self._queue and len(tasks) < self.max_concurrency:
+                timeout = max(0.0, self._queue[0][0] - loop.time())
+
+            waiting = tasks | self._retrieves | self._submissions
+            if ingest is not None and not ingest.done():
+                # wake up when the input adds a series
+                self._added.clear()
+                waiting |= {ingest, asyncio.ensure_future(self._added.wait())}
+            if waiting:
+                done, pending = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                tasks.difference_update(done)
+                for waiter in pending - tasks - self._retrieves - self._submissions - {ingest}:
+                    waiter.cancel()
+            elif timeout is not None:
+                await asyncio.sleep(timeout)
+
+        if ingest is not None:
+            # surface input errors
+            await ingest
+        return self.contains_errors
+
+    async def _ingest(self, source):
+        async for series in source:
+            self.add(series)
+
+    async def _step(self, series_instance: str):
+        """
+        Run one poll for a series and decide what happens to it next.
+        """
+        series = self._series[series_instance]
+        try:
+            LOG(f"Polling CUBE for series: {series_instance}.")
+            if series.status == "registered" or await self._is_registered(series):
+                self._registered(series)
+                if self.options.batchStudies:
+                    self._collect(series)
+                else:
+                    self._submit([series])
+                return
+
+            registered_files = await self._series_files(series)
+            self._record(series_instance, "polled", registered_files=registered_files)
+            delay = self.poller.next_delay(series, registered_files, asyncio.get_running_loop().time())
+            if delay is not None:
+                series.poll_count += 1
+                self._schedule(series_instance, delay)
+                return
+
+            # polling timed out before registration is finished
+            if series.retry <= 0:
+                LOG(f"PACS series registration unsuccessful for {series_instance}. No retries left.")
+                self._fail(series_instance)
+                return
+
+            self._retry_retrieve(series)
+        except Exception as ex:
+            LOG(f"Error while processing series {series_instance}: {ex}")
+            self._fail(series_instance)
+
+    async def _shared(self, key, func, *args):
+        """
+        Run ``func`` at most once per poll interval for ``key``; steps that
+        need it concurrently await the same call.
+        """
+        loop = asyncio.get_running_loop()
+        started, task = self._shared_calls.get(key, (0.0, None))
+        if task is None or (task.done() and loop.time() - started >= self.options.pollInterval):
+            task = asyncio.ensure_future(func(*args))
+            self._shared_calls[key] = (loop.time(), task)
+        return await asyncio.shield(task)
+
+    async def _is_registered(self, series: SeriesState) -> bool:
+        series_instance = series.SeriesInstanceUID
+        if self.watcher is not None and series.poll_count > 0:
+            try:
+                pending = set(self._series) - self.watcher.registered
+                await self._shared("sweep", self.watcher.sweep, pending)
+            except Exception as ex:
+                LOG(f"Sweep for newly registered series failed: {ex}")
+            return series_instance in self.watcher.registered
+
+        study_instance = series.StudyInstanceUID
+        try:
+            status = await self._shared(("study", study_instance), self.client.get_study_registration,
+                                        study_instance, set(self._studies[study_instance]))
+        except Exception as ex:
+            # a missed poll: the poller retries or gives up on the series once it stalls
+            LOG(f"Registration lookup of study {study_instance} failed: {ex}")
+            return False
+        entry = status.get(series_instance, {})
+        LOG(f"Series {series_instance} registered in CUBE: {entry.get('registered', False)}.")
+        return entry.get("registered", False)
+
+    async def _series_files(self, series: SeriesState) -> int:
+        """
+        Files of a series registered so far; the last known count if the
+        lookup fails.
+        """
+        series_instance = series.SeriesInstanceUID
+        try:
+            return await self.client.get_series_file_count(series_instance)
+        except Exception as ex:
+            LOG(f"Counting registered files of series {series_instance} failed: {ex}")
+            return series.registered_files
+
+    def _fail(self, series_instance: str):
+        self.contains_errors = True
+        series = self._series.get(series_instance)
+        if series is not None:
+            series.status = "pipeline not started" if series.status == "registered" else "registration failed"
+            self._record(series_instance, "finished", status=series.status)
+            self._remove(series_instance)
+            # the rest of the study may be waiting for this series
+            self._check_batch(series.StudyInstanceUID)
+
+    def _retry_retrieve(self, series: SeriesState):
+        """
+        Request the series again from pfdcm in the background. Polling of
+        the series resumes once pfdcm reports the retrieve complete.
+        """
+        series_instance = series.SeriesInstanceUID
+        LOG(f"PACS series registration unsuccessful. Retrying retrieve for {series_instance}.")
+        directive = series.directive()
+        series.retry -= 1
+        self._record(series_instance, "retry", retry=series.retry)
+        series.queued_at = asyncio.get_running_loop().time()
+        task = asyncio.ensure_future(self._follow_retrieve(series, directive))
+        self._retrieves.add(task)
+        task.add_done_callback(self._retrieves.discard)
+
+    async def _follow_retrieve(self, series: SeriesState, directive: dict):
+        series_instance = series.SeriesInstanceUID
+        retrieve_response = None
+        try:
+            retrieve_response, retrieved = await self.pfdcm.retrieve(
+                directive, self._study_members[series.StudyInstanceUID])
+            self._save_retrieve(directive, retrieve_response)
+        except Exception as ex:
+            logger.error(f"Retrieve for {series_instance} failed: {ex}")
+            if retrieve_response is None:
+                self._save_retrieve(directive, {"error": str(ex)})
+            # back to polling: the next retry waits for a full stall timeout, as after any other retrieve
+            retrieved = None
+
+        # poll right away once pfdcm is done, else fall back to the predicted registration time
+        delay = 0.0 if retrieved else max(self._first_poll_delay(series), self.poller.base_interval)
+        self.poller.reset(series, asyncio.get_running_loop().time() + delay)
+        self._schedule(series_instance, delay)
+
+    def _registered(self, series: SeriesState):
+        LOG(f"Series {series.SeriesInstanceUID} successfully registered to CUBE.")
+        if series.status != "registered":
+            series.status = "registered"
+            self.stats.record(series.Modality, series.NumberOfSeriesRelatedInstances,
+                              asyncio.get_running_loop().time() - series.queued_at)
+
+    def _collect(self, series: SeriesState):
+        """
+        Add a registered series to the batch of its study. The batch is
+        submitted once the other series of the study are registered or
+        have failed, or ``options.batchWait`` seconds after it was opened.
+        """
+        study_instance = series.StudyInstanceUID
+        batch = self._batches.get(study_instance)
+        if batch is None:
+            batch = self._batches[study_instance] = {"series": [], "ready": asyncio.Event()}
+            self._spawn_submission(self._follow_batch(study_instance, batch))
+        batch["series"].append(series)
+        self._check_batch(study_instance)
+
+    def _check_batch(self, study_instance: str):
+        batch = self._batches.get(study_instance)
+        if batch is None:
+            return
+        collected = {series.SeriesInstanceUID for series in batch["series"]}
+        if self._studies.get(study_instance, set()) <= collected:
+            batch["ready"].set()
+
+    async def _follow_batch(self, study_instance: str, batch: dict):
+        try:
+            await asyncio.wait_for(batch["ready"].wait(), self.options.batchWait)
+        except asyncio.TimeoutError:
+            LOG(f"Study {study_instance}: submitting {len(batch['series'])} registered series "
+                f"without waiting any longer for the rest of the study.")
+        del self._batches[study_instance]
+        # series of the study registered from now on start a new batch
+        study = self._studies.get(study_instance, set())
+        study.difference_update(series.SeriesInstanceUID for series in batch["series"])
+        if not study:
+            self._studies.pop(study_instance, None)
+        await self._follow_submission(batch["series"])
+
+    def _submit(self, batch: list[SeriesState]):
+        """
+        Start anonymization of registered series in the background.
+        """
+        self._spawn_submission(self._follow_submission(batch))
+
+    def _spawn_submission(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._submissions.add(task)
+        task.add_done_callback(self._submissions.discard)
+
+    async def _follow_submission(self, batch: list[SeriesState]):
+        try:
+            backpressure = nullcontext()
+            if self.monitor is not None and self.monitor.max_jobs:
+                backpressure = self.monitor.submission(await self.cube_con.workflow_jobs())
+            async with backpressure, self._submit_slots:
+                await self._finish(batch)
+        except Exception as ex:
+            LOG(f"Error while submitting series {', '.join(series.SeriesInstanceUID for series in batch)}: {ex}")
+            for series in batch:
+                self._fail(series.SeriesInstanceUID)
+
+    def _save_retrieve(self, directive: dict, retrieve_response: dict):
+        self._record(directive["SeriesInstanceUID"], "retrieve", retrieve_response=retrieve_response)
+
+    async def _finish(self, batch: list[SeriesState]):
+        """
+        Anonymize registered series together: one dsdircopy instance over
+        their folders and one workflow.
+        """
+        send_params = {
+            "neuro_dcm_location": self.options.neuroDicomLocation,
+            "neuro_anon_location": self.options.neuroAnonLocation,
+            "neuro_nifti_location": self.options.neuroNiftiLocation,
+            "folder_name": self.options.folderName,
+            "recipients": self.options.recipients,
+            "smtp_server": self.options.SMTPServer
+        }
+        series_instances = [series.SeriesInstanceUID for series in batch]
+        entries = [self.journal.entry(series_instance) if self.journal else {} for series_instance in series_instances]
+        dicom_dirs = await asyncio.gather(*(
+            self._dicom_dir(series_instance, entry) for series_instance, entry in zip(series_instances, entries)))
+        dicom_dir = ','.join(dicom_dirs)
+        series_data = json.dumps(batch_directive(batch)) if len(batch) > 1 else batch[0].to_json()
+
+        # a journaled dsdircopy instance is reused only for the same batch of series
+        dsdir_inst_id = entries[0].get("dsdircopy_id")
+        if any(entry.get("dsdircopy_id") != dsdir_inst_id or entry.get("batch", [series_instance]) != series_instances
+               for series_instance, entry in zip(series_instances, entries)):
+            dsdir_inst_id = None
+        if dsdir_inst_id is None:
+            dsdir_inst_id = await self.cube_con.start_submission(dicom_dir, self.options.pluginInstanceID)
+            if dsdir_inst_id is None:
+                for series_instance in series_instances:
+                    self._fail(series_instance)
+                return
+            for series_instance in series_instances:
+                self._record(series_instance, "dsdircopy", dsdircopy_id=dsdir_inst_id, batch=series_instances)
+
+        d_ret = await self.cube_con.anonymize(dicom_dir, send_params, self.options.pluginInstanceID, series_data,
+                                              dsdir_inst_id)
+        if d_ret.get('error'):
+            self.contains_errors = True
+        for series in batch:
+            if d_ret.get('error'):
+                series.status = "pipeline not started"
+            else:
+                series.status = "pipeline running"
+                series.workflow_id = d_ret.get("workflow_id")
+            self._record(series.SeriesInstanceUID, "finished", status=series.status, workflow_id=series.workflow_id,
+                         total_jobs=d_ret.get("total_jobs"))
+            self._remove(series.SeriesInstanceUID)
+
+    async def _dicom_dir(self, series_instance: str, entry: dict) -> str:
+        dicom_dir = entry.get("dicom_dir") or await self.client.get_pacs_files({'SeriesInstanceUID': series_instance})
+        self._record(series_instance, "registered", registered=True, dicom_dir=dicom_dir)
+        return dicom_dir
+
+
+def batch_directive(batch: list[SeriesState]) -> dict:
+    """
+    Series details of a study batch: those of its first series, with the
+    UIDs, modalities and instance counts of the whole batch.
+    """
+    directive = batch[0].directive()
+    directive["SeriesInstanceUID"] = ','.join(series.SeriesInstanceUID for series in batch)
+    directive["Modality"] = ','.join(dict.fromkeys(series.Modality for series in batch))
+    directive["NumberOfSeriesRelatedInstances"] = sum(
+        int(series.NumberOfSeriesRelatedInstances) for series in batch)
+    return directive
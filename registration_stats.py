@@ -0,0 +1,114 @@
+### Registration Time Statistics ###
+
+import os
+import json
+import threading
+from loguru import logger
+
+LOG = logger.debug
+
+# Observations needed for a modality before its predictions are used
+MIN_SAMPLES = 3
+# Weight kept by older observations each time a new one is recorded
+DECAY = 0.95
+
+
+class RegistrationStats:
+    """
+    Registration latencies observed in past runs, per modality.
+
+    Each modality keeps exponentially decayed sums of (file count,
+    seconds until registered) so that ``predict`` can fit
+    ``seconds = overhead + per_file * files`` by least squares, with recent
+    runs weighing most. When ``path`` is given, the sums are loaded from
+    and saved to that JSON file.
+    """
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self._models: dict = {}
+        # observations recorded by this process, see ``merge``
+        self.recorded: list = []
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def record(self, modality: str, files, seconds: float):
+        """
+        Add one observed registration latency of a series.
+        """
+        try:
+            files = float(files)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            model = self._models.setdefault(modality or "", {"n": 0.0, "sx": 0.0, "sy": 0.0, "sxx": 0.0, "sxy": 0.0})
+            for key in ("n", "sx", "sy", "sxx", "sxy"):
+                model[key] *= DECAY
+            model["n"] += 1
+            model["sx"] += files
+            model["sy"] += seconds
+            model["sxx"] += files * files
+            model["sxy"] += files * seconds
+            model["count"] = model.get("count", 0) + 1
+            self.recorded.append((modality, files, seconds))
+
+    def merge(self, observations: list):
+        """
+        Record observations made elsewhere, e.g. by worker processes.
+        """
+        for modality, files, seconds in observations:
+            self.record(modality, files, seconds)
+
+    def predict(self, modality: str, files):
+        """
+        Expected seconds until a series of ``files`` files is registered,
+        or ``None`` if there is not enough history for the modality.
+        """
+        try:
+            files = float(files)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            model = self._models.get(modality or "")
+            if model is None or model.get("count", 0) < MIN_SAMPLES:
+                return None
+            n = model["n"]
+            mean_x, mean_y = model["sx"] / n, model["sy"] / n
+            var_x = model["sxx"] / n - mean_x * mean_x
+            per_file = (model["sxy"] / n - mean_x * mean_y) / var_x if var_x > 1e-6 else 0.0
+        if per_file <= 0:
+            return mean_y
+        return max(mean_y + per_file * (files - mean_x), 0.0)
+
+    def load(self):
+        """
+        Read the stats file, if it exists.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as stats_file:
+                models = json.load(stats_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            LOG(f"Ignoring unreadable registration stats {self.path}: {ex}")
+            return
+        with self._lock:
+            self._models.update(models)
+
+    def save(self):
+        """
+        Write the stats file, if one is configured.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            models = json.loads(json.dumps(self._models))
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as stats_file:
+                json.dump(models, stats_file)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            LOG(f"Could not save registration stats {self.path}: {ex}")
@@ -0,0 +1,88 @@
+### Run Journal Implementation ###
+
+import os
+import json
+import time
+import threading
+from loguru import logger
+
+LOG = logger.debug
+
+# Journal file name in the plugin output directory
+JOURNAL_FILE = "dy_regiFlow.journal.jsonl"
+
+# Final statuses after which a series is not processed again
+DONE_STATUSES = ("pipeline complete",)
+# Status of a series whose workflow was started but not seen finishing
+RUNNING_STATUS = "pipeline running"
+
+
+class RunJournal:
+    """
+    Append-only JSONL log of series state changes.
+
+    Every event is one line ``{"time", "series", "event", ...data}``
+    written as soon as it happens, with a single ``O_APPEND`` write so
+    that threads and processes sharing the journal do not interleave
+    lines. On open, existing lines are replayed into ``state``: the
+    latest value of every data field per series, so that a rerun can
+    skip finished series and resume the others. A line cut short by a
+    killed run is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state: dict = {}
+        self._lock = threading.Lock()
+        self.load()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        # terminate a line cut short by a killed run
+        size = os.lseek(self._fd, 0, os.SEEK_END)
+        if size and os.pread(self._fd, 1, size - 1) != b'\n':
+            os.write(self._fd, b'\n')
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(entry)
+        except FileNotFoundError:
+            return
+        if self.state:
+            LOG(f"Resuming {len(self.state)} series from journal {self.path}.")
+
+    def record(self, series_instance: str, event: str, **data):
+        """
+        Append one state change of a series.
+        """
+        entry = {"time": time.time(), "series": series_instance, "event": event, **data}
+        line = (json.dumps(entry, default=str) + '\n').encode('utf-8')
+        with self._lock:
+            self._apply(entry)
+            os.write(self._fd, line)
+
+    def entry(self, series_instance: str) -> dict:
+        """
+        Replayed state of a series; empty if it was never journaled.
+        """
+        return self.state.get(series_instance, {})
+
+    def is_done(self, series_instance: str) -> bool:
+        return self.entry(series_instance).get("status") in DONE_STATUSES
+
+    def is_running(self, series_instance: str) -> bool:
+        entry = self.entry(series_instance)
+        return entry.get("status") == RUNNING_STATUS and entry.get("workflow_id") is not None
+
+    def close(self):
+        with self._lock:
+            os.close(self._fd)
+
+    def _apply(self, entry: dict):
+        series_state = self.state.setdefault(entry.get("series"), {})
+        series_state.update({key: value for key, value in entry.items() if key not in ("time", "series")})
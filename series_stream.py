@@ -0,0 +1,164 @@
+### Streaming Series Ingestion ###
+
+import json
+import asyncio
+from loguru import logger
+
+from series_table import SERIES_FIELDS
+
+LOG = logger.debug
+
+# Characters read from an input file at a time
+CHUNK_SIZE = 1 << 16
+
+
+def validate_series(record) -> dict:
+    """
+    Check that an input record describes a series; raise ``ValueError``
+    otherwise.
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"Expected a series object, got {type(record).__name__}")
+    missing = [field for field in SERIES_FIELDS if field not in record]
+    if missing:
+        raise ValueError(f"Series record is missing {', '.join(missing)}")
+    if not record["SeriesInstanceUID"] or not record["StudyInstanceUID"]:
+        raise ValueError("Series record has an empty SeriesInstanceUID or StudyInstanceUID")
+    try:
+        int(record["NumberOfSeriesRelatedInstances"])
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid NumberOfSeriesRelatedInstances {record['NumberOfSeriesRelatedInstances']!r}")
+    return record
+
+
+class ArrayParser:
+    """
+    Incremental parser of a top-level JSON array: ``feed`` it text as it
+    is read and it returns the elements completed so far.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._started = False
+        # an element was read and no comma after it yet
+        self._after_item = False
+        # a comma was read and no element after it yet
+        self._after_comma = False
+        self.finished = False
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        items = []
+        pos = 0
+        buffer = self._buffer
+        while not self.finished:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if not self._started:
+                if char != '[':
+                    raise ValueError("Input is not a JSON array")
+                self._started = True
+                pos += 1
+                continue
+            if char == ']':
+                if self._after_comma:
+                    raise ValueError("Trailing comma in JSON array")
+                self.finished = True
+                pos += 1
+                break
+            if self._after_item:
+                if char != ',':
+                    raise ValueError(f"Expected ',' or ']' between JSON array elements, got {char!r}")
+                self._after_item = False
+                self._after_comma = True
+                pos += 1
+                continue
+            if char == ',':
+                raise ValueError("Missing JSON array element before ','")
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # element not complete yet
+                break
+            if type(item) in (int, float) and (end >= len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                # a number may continue in the next chunk
+                break
+            items.append(item)
+            self._after_item = True
+            self._after_comma = False
+            pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+    def close(self):
+        if not self.finished:
+            raise ValueError("Truncated JSON array")
+
+
+def iter_records(path):
+    """
+    Yield the elements of the JSON array in ``path`` one at a time.
+    """
+    parser = ArrayParser()
+    with open(path, 'r', encoding='utf-8') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield from parser.feed(chunk)
+    parser.close()
+
+
+class SeriesStream:
+    """
+    Async stream of the valid, distinct series records of several input
+    files, read incrementally so that the first series can be scheduled
+    before the files are fully read.
+
+    Invalid records are logged and counted in ``invalid``; a series
+    already seen in an earlier record is counted in ``duplicates``.
+    """
+
+    def __init__(self, paths: list):
+        self.paths = paths
+        self.invalid = 0
+        self.duplicates = 0
+        self._seen: set = set()
+
+    async def __aiter__(self):
+        for path in self.paths:
+            count = 0
+            parser = ArrayParser()
+            with open(path, 'r', encoding='utf-8') as file:
+                while True:
+                    chunk = await asyncio.to_thread(file.read, CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for record in parser.feed(chunk):
+                        count += 1
+                        series = self._accept(record, path)
+                        if series is not None:
+                            yield series
+            parser.close()
+            # null check
+            if count == 0:
+                raise Exception(f"Cannot verify registration for empty pacs data.")
+        if self.duplicates:
+            LOG(f"Dropped {self.duplicates} duplicate series across {len(self.paths)} input files.")
+
+    def _accept(self, record, path):
+        try:
+            validate_series(record)
+        except ValueError as ex:
+            logger.error(f"Skipping invalid record in {path}: {ex}")
+            self.invalid += 1
+            return None
+        if record["SeriesInstanceUID"] in self._seen:
+            self.duplicates += 1
+            return None
+        self._seen.add(record["SeriesInstanceUID"])
+        return record
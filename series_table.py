@@ -0,0 +1,102 @@
+### Series State Table Implementation ###
+
+import json
+
+# DICOM fields copied from each input record
+SERIES_FIELDS = (
+    "SeriesInstanceUID",
+    "StudyInstanceUID",
+    "AccessionNumber",
+    "PatientID",
+    "StudyDate",
+    "Modality",
+    "NumberOfSeriesRelatedInstances",
+)
+
+
+class SeriesState:
+    """
+    Compact per-series registration state.
+
+    Uses ``__slots__`` so that a table of tens of thousands of series does
+    not carry a ``__dict__`` per entry, and state is updated in place
+    instead of being copied between polls.
+    """
+
+    __slots__ = SERIES_FIELDS + ("retry", "poll_count", "registered_files", "stalled_polls", "last_progress",
+                                 "queued_at", "status", "workflow_id")
+
+    def __init__(self, record: dict, retry: int):
+        for field in SERIES_FIELDS:
+            setattr(self, field, record[field])
+        self.retry = retry
+        self.poll_count = 0
+        # registration progress, maintained by polling.AdaptivePoller
+        self.registered_files = 0
+        self.stalled_polls = 0
+        self.last_progress = 0.0
+        # loop time the current retrieve attempt started being polled for
+        self.queued_at = 0.0
+        # outcome reported in the output file
+        self.status = "pending"
+        self.workflow_id = None
+
+    def directive(self) -> dict:
+        """
+        Series fields plus the remaining retry count, as sent to pfdcm.
+        """
+        d_series = {field: getattr(self, field) for field in SERIES_FIELDS}
+        d_series["retry"] = self.retry
+        return d_series
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def to_json(self) -> str:
+        return json.dumps(self.directive())
+
+    def outcome(self) -> dict:
+        return {"status": self.status, "workflow_id": self.workflow_id}
+
+
+class SeriesTable:
+    """
+    Series state keyed by SeriesInstanceUID.
+    """
+
+    __slots__ = ("_rows",)
+
+    def __init__(self):
+        self._rows: dict = {}
+
+    def add(self, record: dict, retry: int) -> SeriesState:
+        series = SeriesState(record, retry)
+        self._rows[series.SeriesInstanceUID] = series
+        return series
+
+    def pop(self, series_instance: str, default=None):
+        return self._rows.pop(series_instance, default)
+
+    def values(self):
+        return self._rows.values()
+
+    def __getitem__(self, series_instance: str) -> SeriesState:
+        return self._rows[series_instance]
+
+    def __contains__(self, series_instance: str) -> bool:
+        return series_instance in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def outcomes(self) -> dict:
+        """
+        Outcome of every series, keyed by SeriesInstanceUID.
+        """
+        return {series_instance: series.outcome() for series_instance, series in self._rows.items()}
+
+    def to_json(self) -> str:
+        return json.dumps([series.to_dict() for series in self._rows.values()])
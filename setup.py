@@ -25,7 +25,7 @@ setup(
     author='FNNDSC',
     author_email='dev@babyMRI.org',
     url='https://github.com/FNNDSC/pl-dy_regi',
-    py_modules=['dy_regiFlow','chris_pacs_service','base_client','chrisClient','pipeline','pfdcm'],
+    py_modules=['dy_regiFlow','chris_pacs_service','base_client','chrisClient','pipeline','pfdcm','registration_scheduler','series_table','http_session','metadata_cache','workflow_monitor','polling','registration_stats','parallel','series_stream','run_journal','governor','collection_json'],
     install_requires=['chris_plugin'],
     license='MIT',
     entry_points={
@@ -0,0 +1,165 @@
+import asyncio
+from urllib.parse import parse_qs, urlparse
+
+from chris_pacs_service import AsyncPACSClient, AsyncSeriesWatcher, PACSClient
+from collection_json import item_record
+
+
+def series_item(series_id, series_instance, study_instance='9.0', folder_path=None):
+    data = {'id': series_id, 'creation_date': f"2026-01-01T00:00:{series_id:02d}", 'SeriesInstanceUID': series_instance,
+            'StudyInstanceUID': study_instance}
+    if folder_path:
+        data['folder_path'] = folder_path
+    return {'data': [{'name': name, 'value': value} for name, value in data.items()],
+            'links': [{'rel': 'folder', 'href': f"folder:{series_instance}"}]}
+
+
+class FakeCube:
+    """
+    PACS series newest-first, served ``page_size`` items per page; every
+    request is recorded in ``requests``.
+    """
+
+    def __init__(self, page_size=2):
+        self.series = []
+        self.page_size = page_size
+        self.requests = []
+
+    def register(self, series_instance, **kwargs):
+        self.series.insert(0, series_item(len(self.series) + 1, series_instance, **kwargs))
+
+    def page(self, listed, offset, study_instance=''):
+        end = offset + self.page_size
+        links = [{'rel': 'next', 'href': f"page:{study_instance}:{end}"}] if end < len(listed) else []
+        return {'collection': {'items': listed[offset:end], 'links': links, 'total': len(listed)}}
+
+    def request(self, method, endpoint, **kwargs):
+        self.requests.append(endpoint)
+        if endpoint.startswith('folder:'):
+            return {'collection': {'items': [{'data': [{'name': 'path', 'value': f"SERVICES/PACS/{endpoint[7:]}"}]}]}}
+        listed = self.series
+        query = parse_qs(urlparse(endpoint).query)
+        for name in ('StudyInstanceUID', 'SeriesInstanceUID'):
+            if name in query:
+                listed = [item for item in listed if item_record(item)[name] == query[name][0]]
+        if endpoint.startswith('page:'):
+            study_instance, offset = endpoint[5:].split(':')
+            listed = [item for item in listed if study_instance in ('', item_record(item).StudyInstanceUID)]
+            return self.page(listed, int(offset), study_instance)
+        return self.page(listed, 0, query.get('StudyInstanceUID', [''])[0])
+
+    async def make_request(self, method, endpoint, **kwargs):
+        return self.request(method, endpoint, **kwargs)
+
+
+def make_client(cube, client_class=AsyncPACSClient):
+    client = client_class('http://cube.test/api/v1/', 'token')
+    client.make_request = cube.make_request if client_class is AsyncPACSClient else cube.request
+    return client
+
+
+def test_sweep_pages_down_to_the_watermark():
+    cube = FakeCube()
+    for series_instance in ('1.1', '1.2', '1.3'):
+        cube.register(series_instance)
+    watcher = AsyncSeriesWatcher(make_client(cube))
+
+    async def run():
+        await watcher.prime()
+        assert watcher.watermark['id'] == 3
+        for series_instance in ('1.4', '1.5', '1.6', '1.7'):
+            cube.register(series_instance)
+        cube.requests.clear()
+        found = await watcher.sweep({'1.1', '1.5', '1.7', '2.1'})
+        return found, len(cube.requests)
+
+    found, requests = asyncio.run(run())
+    # series registered before priming are left to direct lookups
+    assert found == {'1.5', '1.7'}
+    assert watcher.watermark['id'] == 7
+    # two pages of new series, the second ending at the watermark
+    assert requests == 3
+
+
+def test_sweep_without_new_series_is_one_request():
+    cube = FakeCube()
+    cube.register('1.1')
+    watcher = AsyncSeriesWatcher(make_client(cube))
+
+    async def run():
+        await watcher.prime()
+        cube.requests.clear()
+        return await watcher.sweep({'1.2'})
+
+    assert asyncio.run(run()) == set()
+    assert len(cube.requests) == 1
+    assert watcher.watermark['id'] == 1
+
+
+def test_sweep_remembers_folder_paths():
+    cube = FakeCube()
+    watcher = AsyncSeriesWatcher(make_client(cube))
+
+    async def run():
+        await watcher.prime()
+        cube.register('1.1', folder_path='SERVICES/PACS/study/1.1')
+        await watcher.sweep({'1.1'})
+        cube.requests.clear()
+        return await watcher.client.get_pacs_files({'SeriesInstanceUID': '1.1'})
+
+    assert asyncio.run(run()) == 'SERVICES/PACS/study/1.1'
+    assert cube.requests == []
+
+
+def make_study(cube):
+    cube.register('1.1', folder_path='SERVICES/PACS/study/1.1')
+    cube.register('2.1', study_instance='9.1')
+    cube.register('1.2')
+    cube.register('1.3')
+
+
+def test_study_registration_is_one_paged_search():
+    cube = FakeCube()
+    make_study(cube)
+    client = make_client(cube)
+    status = asyncio.run(client.get_study_registration('9.0', {'1.1', '1.2', '1.4'}))
+    assert status == {'1.1': {'registered': True, 'path': 'SERVICES/PACS/study/1.1'},
+                      '1.2': {'registered': True, 'path': 'SERVICES/PACS/1.2'},
+                      '1.4': {'registered': False, 'path': ''}}
+    # two pages of the study, and the folder link of the series without a folder_path
+    assert len(cube.requests) == 3
+    assert sum(endpoint.startswith('folder:') for endpoint in cube.requests) == 1
+
+
+def test_sync_client_returns_the_same_study_registration():
+    cube = FakeCube()
+    make_study(cube)
+    expected = asyncio.run(make_client(cube).get_study_registration('9.0'))
+    assert make_client(cube, PACSClient).get_study_registration('9.0') == expected
+    assert set(expected) == {'1.1', '1.2', '1.3'}
+
+
+def test_folder_path_follows_one_link_and_is_memoized():
+    cube = FakeCube()
+    make_study(cube)
+    client = make_client(cube, PACSClient)
+    assert client.get_pacs_files({'SeriesInstanceUID': '1.2'}) == 'SERVICES/PACS/1.2'
+    # the series search and its folder link only
+    assert cube.requests[1:] == ['folder:1.2']
+    cube.requests.clear()
+    assert client.get_pacs_files({'SeriesInstanceUID': '1.2'}) == 'SERVICES/PACS/1.2'
+    assert cube.requests == []
+
+
+def test_registration_lookup_fills_the_folder_paths():
+    cube = FakeCube()
+    make_study(cube)
+    client = make_client(cube)
+
+    async def run():
+        await client.get_pacs_registered({'SeriesInstanceUID': '1.1'})
+        cube.requests.clear()
+        return await client.get_pacs_files({'SeriesInstanceUID': '1.1'})
+
+    assert asyncio.run(run()) == 'SERVICES/PACS/study/1.1'
+    assert cube.requests == []
@@ -0,0 +1,36 @@
+import pytest
+
+from collection_json import first_value, item_record, items, records
+
+
+def item(**fields):
+    return {'data': [{'name': name, 'value': value} for name, value in fields.items()], 'links': []}
+
+
+RESPONSE = {'collection': {'items': [item(id=1, title='dsdir', status='finished'),
+                                     item(id=2, title='push', status='started')]}}
+
+
+def test_items_accepts_a_response_or_its_items():
+    assert items(RESPONSE) == RESPONSE['collection']['items']
+    assert items(RESPONSE['collection']['items']) == RESPONSE['collection']['items']
+    assert items({}) == []
+    assert items(None) == []
+
+
+def test_records_keep_requested_fields_only():
+    assert records(RESPONSE, ('id', 'status')) == [{'id': 1, 'status': 'finished'}, {'id': 2, 'status': 'started'}]
+    assert records(RESPONSE)[0] == {'id': 1, 'title': 'dsdir', 'status': 'finished'}
+
+
+def test_record_fields_read_as_attributes():
+    record = item_record(item(id=3, title='dsdir'), frozenset(('id',)))
+    assert record.id == 3
+    with pytest.raises(AttributeError):
+        record.title
+
+
+def test_first_value_stops_at_the_first_match():
+    assert first_value(RESPONSE, 'status') == 'finished'
+    assert first_value(RESPONSE, 'missing', 'default') == 'default'
+    assert first_value({'collection': {'items': []}}, 'id') is None
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import governor
+from governor import HostGovernor
+
+
+def test_concurrency_limit_holds_across_async_callers():
+    host_governor = HostGovernor('cube', rate=0, max_concurrency=4)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        await host_governor.acquire_async()
+        peak = max(peak, host_governor.in_flight)
+        await asyncio.sleep(0.01)
+        host_governor.release(0.01, 200)
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(20)))
+
+    asyncio.run(run())
+    assert peak <= 4
+    assert host_governor.in_flight == 0
+    assert host_governor._waiters == []
+
+
+def test_release_from_another_thread_wakes_async_waiter():
+    host_governor = HostGovernor('cube', rate=0, max_concurrency=1)
+    host_governor.acquire()
+
+    async def run():
+        threading.Timer(0.05, host_governor.release, (0.05, 200)).start()
+        await asyncio.wait_for(host_governor.acquire_async(), 1)
+
+    asyncio.run(run())
+    assert host_governor.in_flight == 1
+
+
+def test_token_bucket_caps_rate():
+    host_governor = HostGovernor('cube', rate=20, max_concurrency=100)
+    started = time.monotonic()
+    for _ in range(30):
+        host_governor.acquire()
+        host_governor.release(0.001, 200, adapt=False)
+    # 20 tokens of burst, then 10 more at 20 per second
+    assert time.monotonic() - started >= 0.45
+
+
+def test_overload_halves_limit_and_success_grows_it():
+    host_governor = HostGovernor('cube', rate=0, max_concurrency=8)
+    assert host_governor.limit == 4
+    host_governor.acquire()
+    host_governor.release(0.1, 503)
+    assert host_governor.limit == 2
+    for _ in range(10):
+        host_governor.acquire()
+        host_governor.release(0.1, 200)
+    assert 2 < host_governor.limit <= 8
+
+
+def test_retry_after_pauses_admission():
+    host_governor = HostGovernor('cube', rate=0, max_concurrency=8)
+    host_governor.acquire()
+    host_governor.release(0.1, 429, retry_after='0.2')
+    assert host_governor._try_acquire() > 0
+
+
+def test_for_url_shares_governor_per_host():
+    governor.configure(rate=10, max_concurrency=2)
+    try:
+        first = governor.for_url('http://cube:8000/api/v1/')
+        assert governor.for_url('http://cube:8000/api/v1/pacs/') is first
+        assert governor.for_url('http://pfdcm:4005/') is not first
+        assert first.rate == 10 and first.max_limit == 2
+    finally:
+        governor.configure()
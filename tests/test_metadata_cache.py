@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from chrisClient import DSDIRCOPY_PLUGIN, AsyncChrisClient
+from metadata_cache import MetadataCache, pipeline_key, plugin_key
+
+
+def test_entries_expire_after_their_ttl():
+    cache = MetadataCache(ttl=60)
+    cache.set('fresh', 1)
+    cache.set('stale', 2, ttl=-1)
+    assert cache.get('fresh') == 1
+    assert cache.get('stale') is None
+    assert cache.get('missing', 'default') == 'default'
+
+
+def test_invalidate_drops_keys_by_prefix():
+    cache = MetadataCache()
+    first, second = pipeline_key('http://cube', 'first'), pipeline_key('http://cube', 'second')
+    cache.set(first, {'id': 1})
+    cache.set(second, {'id': 2})
+    cache.invalidate(first)
+    assert cache.get(first) is None
+    assert cache.get(second) == {'id': 2}
+    cache.invalidate()
+    assert cache.get(second) is None
+
+
+def test_get_or_fetch_fills_a_miss_once():
+    cache = MetadataCache()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return 'value'
+
+    assert cache.get_or_fetch('key', fetch) == 'value'
+    assert cache.get_or_fetch('key', fetch) == 'value'
+    assert len(calls) == 1
+
+
+def test_later_runs_start_warm(tmp_path):
+    path = str(tmp_path / 'cache' / 'metadata.json')
+    cache = MetadataCache(path)
+    cache.set('kept', [1, 2])
+    cache.set('expired', 3, ttl=0.01)
+    time.sleep(0.02)
+    cache.save()
+
+    warm = MetadataCache(path)
+    assert warm.get('kept') == [1, 2]
+    assert 'expired' not in warm._entries
+
+
+def test_unreadable_cache_file_is_ignored(tmp_path):
+    path = tmp_path / 'metadata.json'
+    path.write_text('not json')
+    assert MetadataCache(str(path)).get('key') is None
+
+
+def test_concurrent_misses_share_one_fetch():
+    cache = MetadataCache()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 7
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_fetch_async('key', fetch) for _ in range(5)))
+
+    assert asyncio.run(run()) == [7] * 5
+    assert len(calls) == 1
+    assert cache._pending == {}
+
+
+def test_plugin_id_is_searched_once():
+    client = AsyncChrisClient('http://cube.test/api/v1/', 'token')
+    searches = []
+
+    async def make_request(method, endpoint, **kwargs):
+        searches.append(endpoint)
+        return {'collection': {'items': [{'data': [{'name': 'id', 'value': 7}]}]}}
+
+    client.make_request = make_request
+
+    async def run():
+        return [await client._get_plugin_id(DSDIRCOPY_PLUGIN) for _ in range(3)]
+
+    assert asyncio.run(run()) == [7, 7, 7]
+    assert len(searches) == 1
+    assert client.cache.get(plugin_key(client.api_base, DSDIRCOPY_PLUGIN)) == 7
+
+
+def test_failed_plugin_instance_forgets_the_plugin_id():
+    client = AsyncChrisClient('http://cube.test/api/v1/', 'token')
+    client.cache.set(plugin_key(client.api_base, DSDIRCOPY_PLUGIN), 7)
+
+    async def post_request(endpoint, **kwargs):
+        raise RuntimeError("plugin not found")
+
+    client.post_request = post_request
+    assert asyncio.run(client.run_dicomdir_plugin('SERVICES/PACS/1.1', 1)) is None
+    assert client.cache.get(plugin_key(client.api_base, DSDIRCOPY_PLUGIN)) is None
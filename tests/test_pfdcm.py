@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from pfdcm import AsyncPfdcmClient, retrieve_done, retrieve_progress
+
+
+def directive(series_instance, study_instance='9.0'):
+    return {'SeriesInstanceUID': series_instance, 'StudyInstanceUID': study_instance,
+            'AccessionNumber': 'a', 'PatientID': 'p', 'StudyDate': '20260101'}
+
+
+def make_client(max_jobs=4, batch_window=0.05):
+    """
+    Client whose jobs are recorded in ``posted`` and complete at once.
+    """
+    client = AsyncPfdcmClient('http://pfdcm.test/api/v1/', 'PACS', max_jobs, batch_window, 0.01, 1)
+    client.posted = []
+
+    async def post(job_directive):
+        client.posted.append(job_directive)
+        return {'response': {'job': {'status': True}}}
+
+    async def status(series_directive):
+        return {'requested': 10, 'pushed': 10, 'failed': False}
+
+    client._post = post
+    client.status = status
+    return client
+
+
+def test_study_series_are_retrieved_with_one_directive():
+    client = make_client()
+    study_series = {'1.1', '1.2'}
+
+    async def run():
+        return await asyncio.gather(client.retrieve(directive('1.1'), study_series),
+                                    client.retrieve(directive('1.2'), study_series))
+
+    outcomes = asyncio.run(run())
+    assert len(client.posted) == 1
+    assert 'SeriesInstanceUID' not in client.posted[0]
+    assert client.posted[0]['StudyInstanceUID'] == '9.0'
+    assert [retrieved for _, retrieved in outcomes] == [True, True]
+
+
+def test_part_of_a_study_is_retrieved_per_series():
+    client = make_client()
+
+    async def run():
+        await asyncio.gather(client.retrieve(directive('1.1'), {'1.1', '1.2', '1.3'}),
+                             client.retrieve(directive('1.2'), {'1.1', '1.2', '1.3'}))
+
+    asyncio.run(run())
+    assert sorted(job['SeriesInstanceUID'] for job in client.posted) == ['1.1', '1.2']
+
+
+def test_retrieve_in_progress_is_shared():
+    client = make_client()
+
+    async def run():
+        return await asyncio.gather(client.retrieve(directive('1.1')), client.retrieve(directive('1.1')))
+
+    first, second = asyncio.run(run())
+    assert len(client.posted) == 1
+    assert first == second
+    assert client._in_flight == {}
+
+
+def test_failed_post_reaches_every_series_of_the_job():
+    client = make_client()
+
+    async def post(job_directive):
+        raise RuntimeError("pfdcm unavailable")
+
+    client._post = post
+
+    async def run():
+        return await asyncio.gather(client.retrieve(directive('1.1'), {'1.1', '1.2'}),
+                                    client.retrieve(directive('1.2'), {'1.1', '1.2'}),
+                                    return_exceptions=True)
+
+    outcomes = asyncio.run(run())
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert client._in_flight == {}
+
+
+def test_job_holds_its_slot_until_pfdcm_is_done():
+    client = make_client(max_jobs=1)
+    pulled = asyncio.Event()
+
+    async def status(series_directive):
+        if series_directive['SeriesInstanceUID'] == '1.1' and not pulled.is_set():
+            return {'requested': 10, 'pushed': 3, 'failed': False}
+        return {'requested': 10, 'pushed': 10, 'failed': False}
+
+    client.status = status
+
+    async def run():
+        first = asyncio.ensure_future(client.retrieve(directive('1.1', '9.0')))
+        second = asyncio.ensure_future(client.retrieve(directive('2.1', '9.1')))
+        await asyncio.sleep(0.2)
+        # the pull of 1.1 is still running, so 2.1 has not been sent yet
+        assert [job['SeriesInstanceUID'] for job in client.posted] == ['1.1']
+        pulled.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+    assert [job['SeriesInstanceUID'] for job in client.posted] == ['1.1', '2.1']
+
+
+def test_failed_pull_surfaces_right_away():
+    client = make_client()
+
+    async def status(series_directive):
+        return {'requested': 10, 'pushed': 2, 'failed': True}
+
+    client.status = status
+    with pytest.raises(RuntimeError):
+        asyncio.run(client.retrieve(directive('1.1')))
+
+
+def test_stalled_pull_hands_over_to_cube_polling():
+    client = make_client()
+    client.stall_timeout = 0.05
+
+    async def status(series_directive):
+        return {'requested': 10, 'pushed': 4, 'failed': False}
+
+    client.status = status
+    _, retrieved = asyncio.run(client.retrieve(directive('1.1')))
+    assert retrieved is None
+
+
+def test_retrieve_progress_reads_pfdcm_status():
+    response = {'status': True, 'pypx': {'data': [{
+        'series': {'SeriesInstanceUID': {'value': '1.1'}},
+        'images': {'requested': {'count': 10}, 'packed': {'count': 10}, 'pushed': {'count': 6}},
+        'status': True,
+    }]}}
+    progress = retrieve_progress(response, '1.1')
+    assert progress == {'requested': 10, 'packed': 10, 'pushed': 6, 'failed': False}
+    assert not retrieve_done(progress)
+    assert retrieve_done(dict(progress, pushed=10))
+    assert retrieve_progress(response, '1.2') is None
@@ -0,0 +1,56 @@
+import asyncio
+import copy
+
+import pytest
+
+from pipeline import AsyncPipeline, WorkflowTemplate, compute_workflow_nodes_info, update_plugin_parameters
+
+TITLES = ['dsdir', 'send-dicoms-to-neuro-FS', 'send-anon-dicoms-to-neuro-FS', 'send-niftii-to-neuro-FS']
+
+PARAMETERS = [{
+    'plugin_piping_id': index,
+    'previous_plugin_piping_id': index - 1 if index else None,
+    'plugin_piping_title': title,
+    'param_name': name,
+    'value': 'default',
+} for index, title in enumerate(TITLES) for name in ('path', 'include', 'min_size')]
+
+PLUGIN_PARAMS = {
+    'send-dicoms-to-neuro-FS': {'path': '/neuro/dcm', 'include': '*.dcm'},
+    'send-anon-dicoms': {'path': '/neuro/anon'},
+    'dsdir': {'unknown': 'ignored'},
+}
+
+
+def make_template():
+    return WorkflowTemplate({'id': 3, 'total_jobs': len(TITLES), 'parameters': PARAMETERS})
+
+
+def test_render_matches_update_plugin_parameters():
+    expected = update_plugin_parameters(compute_workflow_nodes_info(PARAMETERS, include_all_defaults=True),
+                                        copy.deepcopy(PLUGIN_PARAMS))
+    assert make_template().render(PLUGIN_PARAMS) == expected
+
+
+def test_render_leaves_template_untouched():
+    template = make_template()
+    pristine = copy.deepcopy(template.nodes_info)
+    rendered = template.render(PLUGIN_PARAMS)
+    assert template.nodes_info == pristine
+    # pipings without overrides are shared with the template
+    assert rendered[3] is template.nodes_info[3]
+    assert rendered[1] is not template.nodes_info[1]
+    assert template.render({}) == pristine
+
+
+def test_run_pipeline_requires_a_monitor():
+    pipeline = AsyncPipeline('http://cube.test/api/v1/', 'token')
+    posted = []
+
+    async def post_workflow(**kwargs):
+        posted.append(kwargs)
+
+    pipeline.post_workflow = post_workflow
+    with pytest.raises(RuntimeError):
+        asyncio.run(pipeline.run_pipeline('pipeline', 1, {}, '', '', '{}'))
+    assert posted == []
@@ -0,0 +1,48 @@
+from polling import AdaptivePoller
+from series_table import SeriesState
+
+
+def make_series(instances=100):
+    return SeriesState({
+        'SeriesInstanceUID': '1.1',
+        'StudyInstanceUID': '9.0',
+        'AccessionNumber': 'a',
+        'PatientID': 'p',
+        'StudyDate': '20260101',
+        'Modality': 'MR',
+        'NumberOfSeriesRelatedInstances': instances,
+    }, 1)
+
+
+def test_backs_off_while_nothing_arrives():
+    poller = AdaptivePoller(1, stall_timeout=100, max_interval=4, jitter=0)
+    series = make_series()
+    poller.reset(series, 0)
+    delays = [poller.next_delay(series, 0, now) for now in (1, 2, 3, 4, 5)]
+    assert delays == [1, 1.5, 2.25, 3.375, 4]
+
+
+def test_aims_at_estimated_completion():
+    poller = AdaptivePoller(1, stall_timeout=100, max_interval=60, jitter=0)
+    series = make_series(100)
+    poller.reset(series, 0)
+    # 20 files in 10s: the remaining 80 are due in 40s
+    assert poller.next_delay(series, 20, 10) == 40
+    assert series.registered_files == 20
+    assert series.stalled_polls == 0
+
+
+def test_gives_up_after_stall_timeout():
+    poller = AdaptivePoller(1, stall_timeout=10, jitter=0)
+    series = make_series()
+    poller.reset(series, 0)
+    # never waits past the stall timeout
+    assert poller.next_delay(series, 0, 9.5) == 0.5
+    assert poller.next_delay(series, 0, 10) is None
+
+
+def test_jitter_stays_in_bounds():
+    poller = AdaptivePoller(1, stall_timeout=100, jitter=0.2)
+    series = make_series()
+    poller.reset(series, 0)
+    assert 0.8 <= poller.next_delay(series, 0, 1) <= 1.2
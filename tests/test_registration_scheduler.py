@@ -0,0 +1,180 @@
+import asyncio
+
+from chris_pacs_service import AsyncSeriesWatcher
+from dy_regiFlow import parser
+from registration_scheduler import RegistrationScheduler
+from run_journal import RunJournal
+from series_table import SeriesTable
+
+
+def make_options(*args):
+    options = parser.parse_args(['--maxPoll', '3', '--pluginInstanceID', '1', *args])
+    # --pollInterval only takes whole seconds
+    options.pollInterval = 0.1
+    return options
+
+
+def make_series(study, *series, instances=10):
+    return [{
+        'SeriesInstanceUID': series_instance,
+        'StudyInstanceUID': study,
+        'AccessionNumber': 'a',
+        'PatientID': 'p',
+        'StudyDate': '20260101',
+        'Modality': 'MR',
+        'NumberOfSeriesRelatedInstances': instances,
+    } for series_instance in series]
+
+
+class FakePACSClient:
+    """
+    Series listed in ``registered`` are registered in CUBE; retrieving a
+    series registers it if it is listed in ``on_retrieve``. ``files``
+    holds the registered file count of series still in progress.
+    """
+
+    def __init__(self, registered=(), on_retrieve=(), lookup_errors=0, files=None):
+        self.registered = set(registered)
+        self.on_retrieve = set(on_retrieve)
+        self.lookup_errors = lookup_errors
+        self.files = files or {}
+
+    async def get_study_registration(self, study_instance, series_instances):
+        if self.lookup_errors:
+            self.lookup_errors -= 1
+            raise RuntimeError("CUBE unavailable")
+        return {series_instance: {'registered': series_instance in self.registered}
+                for series_instance in series_instances}
+
+    async def get_series_file_count(self, series_instance):
+        return self.files.get(series_instance, 0)
+
+    async def get_pacs_files(self, params):
+        return f"SERVICES/PACS/{params['SeriesInstanceUID']}"
+
+
+class FakePfdcm:
+    def __init__(self, client):
+        self.client = client
+        self.retrieved = []
+
+    async def retrieve(self, directive, study_series=None):
+        series_instance = directive['SeriesInstanceUID']
+        self.retrieved.append(series_instance)
+        if series_instance in self.client.on_retrieve:
+            self.client.registered.add(series_instance)
+        return {'status': True}, {'status': True}
+
+
+class FakeChrisClient:
+    def __init__(self):
+        self.submissions = []
+
+    async def start_submission(self, dicom_dir, plugin_instance_id):
+        return 10 + len(self.submissions)
+
+    async def anonymize(self, dicom_dir, send_params, plugin_instance_id, series_data, dsdir_inst_id):
+        self.submissions.append(dicom_dir)
+        return {'status': 'Pipeline running', 'workflow_id': len(self.submissions), 'total_jobs': 4}
+
+
+def run_scheduler(options, records, client, journal=None):
+    cube_con = FakeChrisClient()
+    table = SeriesTable()
+
+    async def run():
+        scheduler = RegistrationScheduler(options, client, cube_con, journal=journal)
+        scheduler.pfdcm = FakePfdcm(client)
+        for record in records:
+            scheduler.add(table.add(record, 1))
+        return await scheduler.run(), scheduler.pfdcm
+
+    errors, pfdcm = asyncio.run(run())
+    return errors, table, cube_con, pfdcm
+
+
+def test_registered_series_are_submitted():
+    records = make_series('9.0', '1.1', '1.2')
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, FakePACSClient(registered={'1.1', '1.2'}))
+    assert not errors
+    assert sorted(cube_con.submissions) == ['SERVICES/PACS/1.1', 'SERVICES/PACS/1.2']
+    assert {series.status for series in table.values()} == {'pipeline running'}
+    assert pfdcm.retrieved == []
+
+
+def test_unregistered_series_is_retrieved_again():
+    records = make_series('9.0', '1.1')
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, FakePACSClient(on_retrieve={'1.1'}))
+    assert not errors
+    assert pfdcm.retrieved == ['1.1']
+    assert table['1.1'].status == 'pipeline running'
+    assert table['1.1'].retry == 0
+
+
+def test_series_fails_once_retries_are_used_up():
+    records = make_series('9.0', '1.1')
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, FakePACSClient())
+    assert errors
+    assert pfdcm.retrieved == ['1.1']
+    assert table['1.1'].status == 'registration failed'
+    assert cube_con.submissions == []
+
+
+def test_progress_is_tracked_per_series():
+    records = make_series('9.0', '1.1', '1.2')
+    # files arriving for a sibling or for a series outside the input do not count for 1.1
+    client = FakePACSClient(on_retrieve={'1.1', '1.2'}, files={'1.2': 7, '1.3': 50})
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, client)
+    assert not errors
+    assert table['1.1'].registered_files == 0
+    assert table['1.2'].registered_files == 7
+    assert sorted(pfdcm.retrieved) == ['1.1', '1.2']
+
+
+def test_failed_study_lookup_is_polled_again():
+    records = make_series('9.0', '1.1', '1.2', '1.3')
+    client = FakePACSClient(registered={'1.1', '1.2', '1.3'}, lookup_errors=1)
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, client)
+    assert not errors
+    assert {series.status for series in table.values()} == {'pipeline running'}
+    assert pfdcm.retrieved == []
+
+
+def test_study_batch_is_submitted_once():
+    records = make_series('9.0', '1.1', '1.2') + make_series('9.1', '2.1')
+    client = FakePACSClient(registered={'1.1', '1.2', '2.1'})
+    errors, table, cube_con, pfdcm = run_scheduler(make_options('--batchStudies'), records, client)
+    assert not errors
+    assert sorted(cube_con.submissions) == ['SERVICES/PACS/1.1,SERVICES/PACS/1.2', 'SERVICES/PACS/2.1']
+    assert table['1.1'].workflow_id == table['1.2'].workflow_id != table['2.1'].workflow_id
+
+
+def test_watch_mode_falls_back_to_study_lookups(monkeypatch):
+    async def prime(watcher):
+        raise RuntimeError("CUBE unavailable")
+
+    monkeypatch.setattr(AsyncSeriesWatcher, 'prime', prime)
+    records = make_series('9.0', '1.1')
+    errors, table, cube_con, pfdcm = run_scheduler(make_options('--watch'), records, FakePACSClient(on_retrieve={'1.1'}))
+    assert not errors
+    assert table['1.1'].status == 'pipeline running'
+
+
+def test_journal_resume_skips_finished_and_restores_registered(tmp_path):
+    journal_file = str(tmp_path / 'journal.jsonl')
+    journal = RunJournal(journal_file)
+    journal.record('1.1', 'finished', status='pipeline complete', workflow_id=7)
+    journal.record('1.2', 'registered', registered=True, dicom_dir='SERVICES/PACS/old')
+    journal.close()
+
+    journal = RunJournal(journal_file)
+    records = make_series('9.0', '1.1', '1.2')
+    # nothing is registered in CUBE: a resumed series must not be polled again
+    errors, table, cube_con, pfdcm = run_scheduler(make_options(), records, FakePACSClient(), journal)
+    journal.close()
+    assert not errors
+    assert table['1.1'].status == 'pipeline complete'
+    assert table['1.1'].workflow_id == 7
+    assert cube_con.submissions == ['SERVICES/PACS/old']
+    assert table['1.2'].status == 'pipeline running'
+    assert RunJournal(journal_file).entry('1.2')['status'] == 'pipeline running'
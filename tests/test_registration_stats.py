@@ -0,0 +1,43 @@
+import pytest
+
+from registration_stats import MIN_SAMPLES, RegistrationStats
+
+
+def test_no_prediction_without_enough_history():
+    stats = RegistrationStats()
+    for _ in range(MIN_SAMPLES - 1):
+        stats.record('MR', 100, 20)
+    assert stats.predict('MR', 100) is None
+    assert stats.predict('CT', 100) is None
+    assert stats.predict('MR', 'unknown') is None
+
+
+def test_fits_overhead_and_time_per_file():
+    stats = RegistrationStats()
+    for files in (50, 100, 150, 200):
+        stats.record('MR', files, 5 + 0.1 * files)
+    assert stats.predict('MR', 300) == pytest.approx(35)
+    assert stats.predict('MR', 0) == pytest.approx(5)
+
+
+def test_one_series_size_predicts_its_mean():
+    stats = RegistrationStats()
+    for seconds in (10, 20, 30):
+        stats.record('CT', 100, seconds)
+    # recent runs weigh most
+    assert 20 < stats.predict('CT', 500) < 21
+
+
+def test_stats_persist_and_merge(tmp_path):
+    path = str(tmp_path / 'stats' / 'registration.json')
+    stats = RegistrationStats(path)
+    for files in (10, 20, 30):
+        stats.record('MR', files, files)
+    stats.save()
+
+    later = RegistrationStats(path)
+    assert later.predict('MR', 40) == pytest.approx(stats.predict('MR', 40))
+
+    merged = RegistrationStats()
+    merged.merge(stats.recorded)
+    assert merged.predict('MR', 40) == pytest.approx(stats.predict('MR', 40))
@@ -0,0 +1,33 @@
+from run_journal import RunJournal
+
+
+def test_replays_latest_state(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = RunJournal(path)
+    journal.record('1.1', 'queued', retry=3)
+    journal.record('1.1', 'retry', retry=2)
+    journal.record('1.2', 'finished', status='pipeline complete', workflow_id=5)
+    journal.record('1.3', 'finished', status='pipeline running', workflow_id=6, total_jobs=4)
+    journal.close()
+
+    resumed = RunJournal(path)
+    assert resumed.entry('1.1') == {'event': 'retry', 'retry': 2}
+    assert resumed.is_done('1.2') and not resumed.is_running('1.2')
+    assert resumed.is_running('1.3') and not resumed.is_done('1.3')
+    assert resumed.entry('1.4') == {}
+    resumed.close()
+
+
+def test_ignores_line_cut_short(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    journal = RunJournal(str(path))
+    journal.record('1.1', 'queued', retry=3)
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"time": 1, "series": "1.1", "ev')
+
+    journal = RunJournal(str(path))
+    assert journal.entry('1.1') == {'event': 'queued', 'retry': 3}
+    journal.record('1.1', 'retry', retry=2)
+    journal.close()
+    assert RunJournal(str(path)).entry('1.1')['retry'] == 2
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from series_stream import ArrayParser, iter_records
+
+
+def feed_chunks(text, size):
+    parser = ArrayParser()
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    parser.close()
+    return items
+
+
+def test_parses_array_split_at_any_point():
+    records = [{'SeriesInstanceUID': f'1.{i}', 'n': i * 1000} for i in range(5)] + [12345, 'text', [1, 2]]
+    text = json.dumps(records, indent=2)
+    for size in (1, 2, 7, len(text)):
+        assert feed_chunks(text, size) == records
+
+
+def test_number_split_between_chunks():
+    parser = ArrayParser()
+    assert parser.feed('[12') == []
+    assert parser.feed('34, 5') == [1234]
+    assert parser.feed(']') == [5]
+    assert parser.finished
+
+
+def test_empty_array():
+    assert feed_chunks(' [ ] ', 1) == []
+
+
+@pytest.mark.parametrize('text', ['{"a": 1}', ', [1]', '1'])
+def test_rejects_non_array(text):
+    with pytest.raises(ValueError):
+        ArrayParser().feed(text)
+
+
+@pytest.mark.parametrize('text', ['[1,,2]', '[,1]', '[1 2]', '[1,]', '[{"a": 1} {"b": 2}]'])
+def test_requires_one_comma_between_elements(text):
+    with pytest.raises(ValueError):
+        feed_chunks(text, 1)
+
+
+def test_rejects_truncated_array():
+    parser = ArrayParser()
+    parser.feed('[{"a": 1}, {"b"')
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_iter_records(tmp_path):
+    path = tmp_path / 'input.json'
+    path.write_text(json.dumps([{'a': 1}, {'b': 2}]))
+    assert list(iter_records(path)) == [{'a': 1}, {'b': 2}]
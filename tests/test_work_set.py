@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from dy_regiFlow import load_work_set, write_outcomes
+
+
+def record(series_instance):
+    return {'SeriesInstanceUID': series_instance, 'StudyInstanceUID': '9.0', 'Modality': 'MR'}
+
+
+def write_inputs(tmp_path, *files):
+    mapper = []
+    for index, series in enumerate(files):
+        input_file = tmp_path / f"in{index}.json"
+        input_file.write_text(json.dumps([record(series_instance) for series_instance in series]))
+        mapper.append((input_file, tmp_path / f"out{index}.json"))
+    return mapper
+
+
+def test_series_listed_by_several_files_is_processed_once(tmp_path):
+    mapper = write_inputs(tmp_path, ['1.1', '1.2'], ['1.2', '1.3'], ['1.1'])
+    file_pairs, work_set = load_work_set(mapper)
+    assert [series['SeriesInstanceUID'] for series in work_set] == ['1.1', '1.2', '1.3']
+    assert [len(records) for records, _ in file_pairs] == [2, 2, 1]
+    assert [output_file for _, output_file in file_pairs] == [output_file for _, output_file in mapper]
+
+
+def test_empty_input_file_is_rejected(tmp_path):
+    mapper = write_inputs(tmp_path, ['1.1'], [])
+    with pytest.raises(Exception):
+        load_work_set(mapper)
+
+
+def test_outcomes_are_written_per_input_file(tmp_path):
+    output_file = tmp_path / 'out.json'
+    outcomes = {'1.1': {'status': 'pipeline complete', 'workflow_id': 4}}
+    write_outcomes(output_file, iter([record('1.1'), record('1.2'), 'skipped']), outcomes)
+    written = json.loads(output_file.read_text())
+    assert written == [{**record('1.1'), 'status': 'pipeline complete', 'workflow_id': 4},
+                       {**record('1.2'), 'status': 'not processed', 'workflow_id': None}]
+
+
+def test_no_records_give_an_empty_list(tmp_path):
+    output_file = tmp_path / 'out.json'
+    write_outcomes(output_file, [], {})
+    assert json.loads(output_file.read_text()) == []
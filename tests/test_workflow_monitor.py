@@ -0,0 +1,156 @@
+import asyncio
+import json
+import threading
+
+from workflow_monitor import MAX_MISSES, JobBudget, WorkflowMonitor
+
+
+def running(jobs=2):
+    return {"finished_jobs": 0, "scheduled_jobs": jobs, "started_jobs": 0, "total_jobs": jobs,
+            "workflow_failed": False, "creation_date": None}
+
+
+def finished(jobs=2, failed=False):
+    return {"finished_jobs": jobs, "scheduled_jobs": 0, "started_jobs": 0, "total_jobs": jobs,
+            "workflow_failed": failed, "creation_date": None}
+
+
+class FakePipeline:
+    """
+    Workflow statuses served from ``statuses``; those in ``hidden`` are
+    missing from the listing and only found by ID.
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.hidden = set()
+        self.listings = []
+        self.fetched = []
+
+    async def list_workflows(self, params, page_size=100):
+        self.listings.append(params)
+        return {workflow_id: status for workflow_id, status in self.statuses.items()
+                if workflow_id not in self.hidden}
+
+    async def get_workflow_status(self, workflow_id):
+        self.fetched.append(workflow_id)
+        if workflow_id not in self.statuses:
+            raise RuntimeError("not found")
+        return self.statuses[workflow_id]
+
+
+def series_data(*series_instances):
+    return json.dumps({"SeriesInstanceUID": ','.join(series_instances)})
+
+
+def test_poll_lists_open_workflows_at_once():
+    pipeline = FakePipeline()
+    pipeline.statuses = {1: dict(running(), creation_date="2026-01-02T10:00:00+00:00"),
+                         2: dict(finished(), creation_date="2026-01-02T09:00:00+00:00"),
+                         3: dict(finished(failed=True), creation_date="2026-01-02T08:00:00+00:00")}
+
+    async def run():
+        monitor = WorkflowMonitor(pipeline, 0.01, 0.01)
+        for workflow_id in pipeline.statuses:
+            monitor.register(workflow_id, 2, series_data(f"1.{workflow_id}"))
+        assert await monitor._poll()
+        return monitor
+
+    monitor = asyncio.run(run())
+    assert len(pipeline.listings) == 1
+    assert pipeline.fetched == []
+    assert monitor.outcomes == {2: "complete", 3: "pipeline failed"}
+    assert list(monitor._open) == [1]
+    # the next listing starts at the oldest workflow still open
+    assert monitor.since == "2026-01-02T10:00:00+00:00"
+
+
+def test_workflow_missing_from_listing_is_fetched_by_id():
+    pipeline = FakePipeline()
+    pipeline.statuses = {1: running(), 2: finished()}
+    pipeline.hidden = {2}
+
+    async def run():
+        monitor = WorkflowMonitor(pipeline, 0.01, 0.01)
+        monitor.register(1, 2, series_data("1.1"))
+        monitor.register(2, 2, series_data("1.2"))
+        await monitor._poll()
+        return monitor
+
+    monitor = asyncio.run(run())
+    assert pipeline.fetched == [2]
+    assert monitor.outcomes == {2: "complete"}
+
+
+def test_unknown_workflow_gives_up_after_repeated_misses():
+    pipeline = FakePipeline()
+
+    async def run():
+        monitor = WorkflowMonitor(pipeline, 0.01, 0.01)
+        monitor.register(7, 2, series_data("1.7", "1.8"))
+        for _ in range(MAX_MISSES - 1):
+            assert not await monitor._poll()
+        assert 7 in monitor._open
+        assert await monitor._poll()
+        monitor.close()
+        return monitor, await asyncio.wait_for(monitor.run(), 1)
+
+    monitor, outcomes = asyncio.run(run())
+    assert outcomes == {7: "status unavailable"}
+    assert monitor.failed == [7]
+    assert pipeline.fetched == [7] * MAX_MISSES
+
+
+def test_shared_budget_holds_workflows_of_all_monitors():
+    budget = JobBudget(8)
+    pipelines = [FakePipeline(), FakePipeline()]
+    started = []
+
+    async def submit(monitor, pipeline, workflow_id):
+        async with monitor.submission(6):
+            started.append(workflow_id)
+            pipeline.statuses[workflow_id] = running(6)
+            monitor.register(workflow_id, 6, series_data(f"1.{workflow_id}"))
+
+    async def run():
+        monitors = [WorkflowMonitor(pipeline, 0.01, 0.01, budget=budget) for pipeline in pipelines]
+        tasks = [asyncio.create_task(monitor.run()) for monitor in monitors]
+        await submit(monitors[0], pipelines[0], 1)
+        second = asyncio.create_task(submit(monitors[1], pipelines[1], 2))
+        await asyncio.sleep(0.1)
+        # 6 jobs in flight and 6 more would exceed 8, even on another monitor
+        assert started == [1]
+        pipelines[0].statuses[1] = finished(6)
+        await asyncio.wait_for(second, 1)
+        assert started == [1, 2]
+        pipelines[1].statuses[2] = finished(6)
+        for monitor in monitors:
+            monitor.close()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert budget.active_jobs == 0
+
+
+def test_budget_admits_one_workflow_larger_than_the_ceiling():
+    budget = JobBudget(4)
+    assert budget.fits(6)
+    budget.update('monitor', 6)
+    assert not budget.fits(1)
+    budget.update('monitor', 0)
+    assert budget.fits(6)
+
+
+def test_budget_wakes_monitor_on_another_thread():
+    budget = JobBudget(4)
+    budget.update('other', 4)
+    woken = threading.Event()
+
+    async def wait():
+        budget.attach('waiting', asyncio.get_running_loop(), woken.set)
+        threading.Timer(0.05, budget.update, ('other', 0)).start()
+        while not woken.is_set():
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(wait(), 1))
+    assert budget.fits(4)
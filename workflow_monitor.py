@@ -0,0 +1,318 @@
+### Workflow Monitor Implementation ###
+
+import math
+import json
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from loguru import logger
+
+from pipeline import AsyncPipeline, workflow_outcome
+from run_journal import RunJournal
+
+LOG = logger.debug
+
+# Workflows fetched per list request
+PAGE_SIZE = 100
+# Margin on the run start time, to absorb clock skew between the plugin and CUBE
+CLOCK_SKEW = timedelta(minutes=10)
+# Consecutive polls a workflow may go without a status before it is given up on
+MAX_MISSES = 5
+
+
+class JobBudget:
+    """
+    Ceiling on the workflow jobs in flight, shared by every
+    ``WorkflowMonitor`` of a process, whichever thread and event loop it
+    runs on.
+
+    Each monitor reports its own jobs in flight; a new workflow fits while
+    the total stays within ``max_jobs``, or when nothing is in flight at
+    all, so that a ceiling below one workflow still lets one through.
+    Monitors waiting for room are woken on their own event loop whenever
+    another monitor's jobs go down.
+    """
+
+    def __init__(self, max_jobs: int = 0):
+        self.max_jobs = max(0, max_jobs)
+        self._lock = threading.Lock()
+        self._jobs: dict = {}
+        self._listeners: dict = {}
+
+    @property
+    def active_jobs(self) -> int:
+        with self._lock:
+            return sum(self._jobs.values())
+
+    def fits(self, jobs: int) -> bool:
+        active_jobs = self.active_jobs
+        return not self.max_jobs or not active_jobs or active_jobs + jobs <= self.max_jobs
+
+    def attach(self, monitor, loop: asyncio.AbstractEventLoop, callback):
+        with self._lock:
+            self._listeners[monitor] = (loop, callback)
+
+    def detach(self, monitor):
+        self.update(monitor, 0)
+        with self._lock:
+            self._listeners.pop(monitor, None)
+            self._jobs.pop(monitor, None)
+
+    def update(self, monitor, jobs: int):
+        """
+        Record the jobs in flight of ``monitor``, and let the others
+        recheck for room if they went down.
+        """
+        with self._lock:
+            freed = jobs < self._jobs.get(monitor, 0)
+            self._jobs[monitor] = jobs
+            listeners = [listener for other, listener in self._listeners.items() if other is not monitor]
+        if not freed:
+            return
+        for loop, callback in listeners:
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                # the monitor's event loop is closed
+                pass
+
+
+class WorkflowMonitor:
+    """
+    Registry of the workflows started by this run.
+
+    Instead of one polling loop per workflow, the monitor fetches the
+    status of every open workflow with paged list queries on
+    ``/pipelines/workflows/search/``. It polls less often when many
+    workflows are open or nothing changed since the last poll, and
+    records the final outcome of each workflow.
+
+    With ``max_jobs`` set, the monitor also applies backpressure to new
+    submissions: ``submission`` holds them while the jobs of the open
+    workflows that CUBE reports scheduled or started, plus submissions
+    under way, reach ``max_jobs``. Monitors given the same ``budget``
+    share one ceiling, its ``max_jobs``.
+
+    The final outcome of every workflow is recorded as a ``finished``
+    event of each of its series in ``journal``, if given.
+    """
+
+    def __init__(self, pipeline: AsyncPipeline, min_interval: float = 5, max_interval: float = 60,
+                 max_jobs: int = 0, journal: RunJournal = None, budget: JobBudget = None):
+        self.pipeline = pipeline
+        self.journal = journal
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget if budget is not None else JobBudget(max_jobs)
+        self.since = (datetime.now(timezone.utc) - CLOCK_SKEW).isoformat()
+        self.outcomes: dict = {}
+        self._open: dict = {}
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._capacity = asyncio.Event()
+        self._submitting = 0
+        self._held = 0
+        self.budget.attach(self, asyncio.get_running_loop(), self._release)
+
+    @property
+    def max_jobs(self) -> int:
+        return self.budget.max_jobs
+
+    def register(self, workflow_id: int, total_jobs: int = None, series_data: str = '{}'):
+        """
+        Start tracking a workflow posted by this run, or one still running
+        from an earlier run. ``total_jobs`` may be unknown for the latter.
+        """
+        # a study batch lists its series comma separated
+        series_instances = [uid for uid in json.loads(series_data).get("SeriesInstanceUID", "").split(',') if uid]
+        workflow = self._open.get(workflow_id)
+        if workflow is not None:
+            # resumed series of a batch that shares the workflow
+            workflow["series"].extend(uid for uid in series_instances if uid not in workflow["series"])
+            return
+        # until its first status, every job of a new workflow counts as in flight
+        self._open[workflow_id] = {"total_jobs": total_jobs, "series": series_instances, "misses": 0,
+                                   "active_jobs": total_jobs or 1}
+        self._report()
+        if len(self._open) == 1:
+            self._wakeup.set()
+
+    @property
+    def active_jobs(self) -> int:
+        """
+        Jobs in flight: scheduled or started jobs of the open workflows,
+        at least one per workflow, plus the jobs of submissions under way.
+        """
+        return self._submitting + sum(max(1, workflow["active_jobs"]) for workflow in self._open.values())
+
+    def has_capacity(self, jobs: int = 1) -> bool:
+        """
+        Whether ``jobs`` more jobs fit under the ceiling of the budget; a
+        submission always fits while no monitor has jobs in flight.
+        """
+        self._report()
+        return self.budget.fits(jobs)
+
+    def _report(self):
+        self.budget.update(self, self.active_jobs)
+
+    @asynccontextmanager
+    async def submission(self, jobs: int = 1):
+        """
+        Wait until a new workflow of ``jobs`` jobs fits under ``max_jobs``
+        and count them as in flight until the block exits.
+        """
+        while not self.has_capacity(jobs):
+            self._held += 1
+            if self._held == 1:
+                LOG(f"{self.active_jobs} jobs in flight, holding new workflows.")
+                # poll now rather than after a backed-off interval
+                self._wakeup.set()
+            self._capacity.clear()
+            try:
+                await self._capacity.wait()
+            finally:
+                self._held -= 1
+        self._submitting += jobs
+        self._report()
+        try:
+            yield
+        finally:
+            self._submitting -= jobs
+            self._release()
+
+    def _release(self):
+        if self.has_capacity():
+            self._capacity.set()
+
+    def close(self):
+        """
+        No more workflows will be registered; ``run`` returns once every
+        open workflow has reached a final state.
+        """
+        self._closed = True
+        self._wakeup.set()
+
+    @property
+    def failed(self) -> list:
+        return [workflow_id for workflow_id, outcome in self.outcomes.items() if outcome != "complete"]
+
+    async def run(self) -> dict:
+        """
+        Poll until closed and drained. Returns the outcome of every
+        workflow, keyed by workflow ID.
+        """
+        interval = self.min_interval
+        try:
+            while True:
+                if self._open:
+                    changed = await self._poll()
+                    interval = self._next_interval(interval, changed)
+                if self._closed and not self._open:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=interval if self._open else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # the jobs of this monitor no longer hold up the others sharing the budget
+            self.budget.detach(self)
+
+        LOG(f"{len(self.outcomes)} workflows finished, {len(self.failed)} did not complete.")
+        return self.outcomes
+
+    def _next_interval(self, interval: float, changed: bool) -> float:
+        """
+        Scale the poll interval with the number of list pages needed, and
+        back off while no workflow changes state and no submission is held.
+        """
+        base = self.min_interval * math.ceil(len(self._open) / PAGE_SIZE) if self._open else self.min_interval
+        if changed or self._held:
+            return min(self.max_interval, base)
+        return min(self.max_interval, max(base, interval * 1.5))
+
+    async def _poll(self) -> bool:
+        """
+        Fetch the status of all open workflows and retire finished ones.
+        Returns ``True`` if any workflow reached a final state.
+        """
+        try:
+            statuses = await self.pipeline.list_workflows({"min_creation_date": self.since}, PAGE_SIZE)
+        except Exception as ex:
+            LOG(f"Listing workflows failed: {ex}")
+            statuses = {}
+
+        changed = False
+        for workflow_id in list(self._open):
+            status = statuses.get(workflow_id)
+            if status is None:
+                status = await self._get_status(workflow_id)
+            if status is None:
+                self._open[workflow_id]["misses"] += 1
+                if self._open[workflow_id]["misses"] >= MAX_MISSES:
+                    self._finish(workflow_id, "status unavailable")
+                    changed = True
+                continue
+            self._open[workflow_id]["misses"] = 0
+            self._open[workflow_id]["active_jobs"] = status["scheduled_jobs"] + status["started_jobs"]
+            self._open[workflow_id]["created"] = _parse_date(status.get("creation_date"))
+            outcome = workflow_outcome(status, self._open[workflow_id]["total_jobs"])
+            if outcome:
+                self._finish(workflow_id, outcome)
+                changed = True
+        self._advance_since()
+        self._release()
+        return changed
+
+    def _advance_since(self):
+        """
+        Start the next listing at the oldest open workflow, so that it
+        pages through the workflows still open rather than every workflow
+        created since the run started. A workflow registered after the
+        window moved past it is fetched on its own once, and its creation
+        date then widens the window again.
+        """
+        created = [workflow["created"] for workflow in self._open.values() if workflow.get("created")]
+        if created:
+            self.since = min(created).isoformat()
+
+    async def _get_status(self, workflow_id: int):
+        """
+        Status of a workflow missing from the listing; ``None`` if unknown.
+        """
+        try:
+            return await self.pipeline.get_workflow_status(workflow_id)
+        except Exception as ex:
+            LOG(f"Fetching status of workflow {workflow_id} failed: {ex}")
+            return None
+
+    def _finish(self, workflow_id: int, outcome: str):
+        workflow = self._open.pop(workflow_id)
+        self.outcomes[workflow_id] = outcome
+        series_instances = ','.join(workflow["series"])
+        if outcome == "complete":
+            logger.info(f"Workflow {workflow_id} ({series_instances}): pipeline complete.")
+        else:
+            logger.error(f"Workflow {workflow_id} ({series_instances}): {outcome}.")
+        if self.journal is not None:
+            for series_instance in workflow["series"]:
+                self.journal.record(series_instance, "finished", status=series_status(outcome),
+                                    workflow_id=workflow_id)
+
+
+def _parse_date(value):
+    """CUBE creation date as an aware datetime, or ``None`` if unreadable."""
+    try:
+        date = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def series_status(outcome: str) -> str:
+    """
+    Final status of a series from the outcome of its workflow.
+    """
+    return "pipeline complete" if outcome == "complete" else outcome